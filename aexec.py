@@ -0,0 +1,152 @@
+import asyncio
+import os
+import subprocess as subp
+import threading
+import weakref
+from contextlib import asynccontextmanager
+from functools import partial
+from shutil import which
+from typing import AsyncIterator, Callable, List, Mapping, Optional, Tuple, TypeVar, Union
+from cli import RunResult, Stage, _kill, _track, _untrack, argv_text, current_executor, interrupted
+from profiling import span
+from retry import NETWORK_RETRY, RetryPolicy, failure_reason, retryable, timed_out
+
+
+T = TypeVar("T")
+Command = Union[str, List[str]]                         # a shell command line or an argv list
+
+NET = "net"
+DEFAULT_LIMITS = {
+    NET: 8,                                             # commands downloading at the same time
+}
+
+
+class ResourceLimiter:
+    """Caps how many commands use each resource at the same time, within an event loop.
+
+    asyncio primitives belong to the loop they are used in, so every loop (e.g. one per
+    scheduler thread) gets its own set of semaphores.
+    """
+
+    def __init__(self, limits: Optional[Mapping[str, int]] = None) -> None:
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        # event loop -> resource -> semaphore
+        self._semaphores: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _semaphore(self, resource: str) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphores = self._semaphores.setdefault(loop, {})
+            if resource not in semaphores:
+                semaphores[resource] = asyncio.Semaphore(self.limits.get(resource, 1))
+            return semaphores[resource]
+
+    @asynccontextmanager
+    async def use(self, resource: Optional[str]) -> AsyncIterator[None]:
+        """Waits for a free slot of `resource`, `None` is never limited."""
+
+        if resource is None:
+            yield
+            return
+        async with self._semaphore(resource):
+            yield
+
+
+_LIMITER = ResourceLimiter()
+
+
+def default_limiter() -> ResourceLimiter:
+    """Returns the limiter shared by every `run` call."""
+
+    return _LIMITER
+
+
+async def _spawn(argv: List[str], text: str, timeout: Optional[float],
+                 env: Optional[Mapping[str, str]]) -> Tuple[int, bytes, bytes]:
+    # like `cli.run`, a missing program is reported as exit code 127 instead of an exception
+    if not which(argv[0], path=(env or os.environ).get("PATH")):
+        return 127, b"", f"{argv[0]}: command not found\n".encode()
+
+    # its own process group lets a kill reach everything the command spawned
+    proc = await asyncio.create_subprocess_exec(
+        *argv, stdin=subp.DEVNULL, stdout=subp.PIPE, stderr=subp.PIPE,
+        env=None if env is None else {**os.environ, **env}, start_new_session=True,
+    )
+    # killed by `cli.interrupt` like the blocking commands
+    _track(proc, True)
+    try:
+        outs, errs = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        _kill(proc, True)
+        await proc.wait()
+        raise subp.TimeoutExpired(text, timeout)
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        _kill(proc, True)
+        await proc.wait()
+        raise
+    finally:
+        _untrack(proc, True)
+
+    return proc.returncode, outs, errs
+
+
+async def run(cmd: Command, *, timeout: Optional[float] = None, env: Optional[Mapping[str, str]] = None,
+              resource: Optional[str] = None) -> RunResult:
+    """Runs a command without blocking the event loop, the asynchronous `cli.run`.
+
+    A string goes through `/bin/sh -c`, a list is executed as is. `env` is added to the
+    current environment. Raises `subp.TimeoutExpired` after `timeout` seconds, and kills the
+    command when the calling task is cancelled.
+    """
+
+    if interrupted():
+        raise KeyboardInterrupt
+    text = cmd if isinstance(cmd, str) else argv_text(cmd)
+    argv = ["/bin/sh", "-c", cmd] if isinstance(cmd, str) else list(cmd)
+
+    async with default_limiter().use(resource):
+        with span(text, "cmd") as current:
+            executor = current_executor()
+            if executor is not None:
+                code, outs, errs = await to_thread(executor, text)
+            else:
+                code, outs, errs = await _spawn(argv, text, timeout, env)
+            current.exit_code = code
+            current.out_bytes = len(outs) + len(errs)
+
+    if interrupted():
+        raise KeyboardInterrupt
+    return RunResult(outs, [Stage(argv, code, errs)])
+
+
+async def retry_run(argv: List[str], *, policy: Optional[RetryPolicy] = None,
+                    retry_if: Optional[Callable[[RunResult], bool]] = None,
+                    resource: Optional[str] = NET) -> RunResult:
+    """Runs `argv` until it exits successfully, the asynchronous `retry.retry_cmd`.
+
+    Returns the result of the last attempt, the resource slot is released while backing off.
+    """
+
+    policy = policy or NETWORK_RETRY
+    for attempt in range(policy.attempts):
+        try:
+            result = await run(argv, timeout=policy.timeout, resource=resource)
+        except subp.TimeoutExpired as exc:
+            result = timed_out(argv, exc)
+
+        if not retryable(result, retry_if) or attempt + 1 >= policy.attempts:
+            return result
+        delay = policy.delay(attempt)
+        print(f"{argv_text(argv)} failed ({failure_reason(result)}), retrying in {delay:.1f}s...")
+        await asyncio.sleep(delay)
+        if interrupted():
+            raise KeyboardInterrupt
+
+    raise ValueError("A retry policy needs at least one attempt.")
+
+
+async def to_thread(func: Callable[..., T], *args, **kwargs) -> T:
+    """Runs a blocking function (downloads, file copies...) in a worker thread."""
+
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
@@ -0,0 +1,143 @@
+from typing import List
+from cli import classify_stderr, comm_live
+from exceptions import InstallationError
+from pkg_index import package_index
+from retry import NETWORK_RETRY, retry_call
+
+
+BATCH_INSTALLS = True                                   # False installs one package per transaction
+FETCH_RETRIES = 3                                       # apt retries a failed package download by itself
+
+_PROXY = ""
+
+
+def use_apt_proxy(url: str) -> None:
+    """Sends apt's http downloads through the proxy at `url`, for the apt commands of this run only.
+
+    Nothing is written to /etc/apt, so apt keeps working once the proxy is gone.
+    """
+
+    global _PROXY
+    _PROXY = url
+
+
+def proxy_options() -> List[str]:
+    """Returns the apt options pointing apt at the proxy set with `use_apt_proxy`, if any."""
+
+    return [f"-oAcquire::http::Proxy={_PROXY}"] if _PROXY else []
+
+
+def missing_apt_pkgs(pkgs: List[str]) -> List[str]:
+    """Returns the packages of `pkgs` that are not installed yet."""
+
+    return package_index().missing_apt(pkgs)
+
+
+def apt_install_argv(pkgs: List[str]) -> List[str]:
+    """Returns the command installing `pkgs` in a single transaction."""
+
+    return ["apt-get", "install", "-y", f"-oAcquire::Retries={FETCH_RETRIES}", *proxy_options(), *pkgs]
+
+
+def apt_install(pkgs: List[str]) -> bool:
+    """Installs `pkgs` in a single `apt-get install` transaction.
+
+    Returns `False` if apt reported an error for the transaction as a whole. Progress is
+    forwarded as apt prints it.
+    """
+
+    if not pkgs:
+        return True
+
+    code, errs = comm_live(apt_install_argv(pkgs), label="apt")
+    if code:
+        for line in classify_stderr(errs).fatal:
+            print(line.decode(errors="replace"))
+        return False
+    return True
+
+
+def find_failing_pkgs(pkgs: List[str]) -> List[str]:
+    """Bisects a failed transaction to find the packages that can not be installed.
+
+    `pkgs` is assumed to have already failed as a whole. Every half that installs
+    cleanly is kept, so only the halves containing a broken package are retried.
+    """
+
+    if len(pkgs) <= 1:
+        return pkgs
+
+    failed: List[str] = []
+    middle = len(pkgs) // 2
+    for half in (pkgs[:middle], pkgs[middle:]):
+        if not apt_install(half):
+            failed += find_failing_pkgs(half)
+    return failed
+
+
+def install_apt_one_by_one(pkgs: List[str]) -> bool:
+    """Installs every package of `pkgs` in its own transaction."""
+
+    try:
+        for pkg in pkgs:
+            print(f"Installing {pkg}...")
+            if not apt_install([pkg]):
+                raise InstallationError(f"Failed to install {pkg}.")
+    finally:
+        package_index().refresh_apt()
+
+    return True
+
+
+def install_apt_batch(pkgs: List[str]) -> bool:
+    """Installs `pkgs` in one transaction, bisecting to report the culprits on failure.
+
+    Packages that are already installed are left out of the transaction.
+    """
+
+    pkgs = missing_apt_pkgs(pkgs)
+    if not pkgs:
+        print("Every package is already installed.")
+        return True
+
+    if not BATCH_INSTALLS:
+        return install_apt_one_by_one(pkgs)
+
+    print(f"Installing {', '.join(pkgs)}...")
+    try:
+        if apt_install(pkgs):
+            return True
+
+        print("Batch installation failed. Looking for the offending packages...")
+        failed = find_failing_pkgs(pkgs)
+    finally:
+        package_index().refresh_apt()
+
+    if failed:
+        raise InstallationError(f"Failed to install {', '.join(failed)}.")
+
+    # the batch failed but every package installed on retry (e.g. a transient mirror error)
+    return True
+
+
+def apt_update_argv() -> List[str]:
+    """Returns the command refreshing the package indexes."""
+
+    return ["apt-get", "update", *proxy_options()]
+
+
+def _apt_update_once() -> None:
+    code, errs = comm_live(apt_update_argv(), label="apt", timeout=NETWORK_RETRY.timeout)
+    if code:
+        for line in classify_stderr(errs).fatal:
+            print(line.decode(errors="replace"))
+        raise InstallationError("Failed to update apt repositories.")
+
+
+def apt_update() -> bool:
+    """Refreshes the package indexes of every configured apt repository, retrying flaky mirrors."""
+
+    print("Updating apt repositories...")
+    retry_call(_apt_update_once, "apt-get update")
+    print("Apt repositories successfully updated.")
+    return True
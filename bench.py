@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Offline benchmark of the installation pipeline.
+
+Runs the real `main_installation` and `main_post_installation` flows against simulated
+apt, snap, git and HTTP backends inside a temporary sandbox, so it needs neither root,
+Ubuntu nor network. Latencies are scaled down by `--scale` to keep a run short.
+
+    python3 bench.py --scale 0.01 --failure-rate 0.05
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import apt
+import cache
+import cli
+import fetch
+import imgs
+import installers
+import journal
+import keyring
+import main
+import pkg_index
+import post_installers
+import retry
+import sources
+
+
+@dataclass
+class Latencies:
+    """Simulated durations in seconds, before scaling."""
+
+    apt_transaction: float = 4.0                        # lock, resolution and triggers of any apt-get install
+    apt_pkg: float = 1.5                                # download and unpack of every package
+    apt_update: float = 12.0
+    snap_pkg: float = 25.0
+    git_clone: float = 3.0
+    http_request: float = 0.3
+    http_mib: float = 0.5                               # per MiB downloaded
+    command: float = 0.05                               # any other command
+
+
+# simulated size of the downloads, in MiB
+DOWNLOAD_SIZES = {
+    "https://dl.google.com/linux/direct/google-chrome-stable_current_amd64.deb": 90.0,
+}
+
+
+class FakeBackend:
+    """Simulated apt, snap, git and shell commands with configurable latency and failure rate.
+
+    Installed packages are written to a fake dpkg status file and snap list, so the real
+    package index and probes work on top of it. apt refuses to run twice at the same
+    time, exactly like the dpkg lock, which catches any scheduling mistake.
+    """
+
+    def __init__(self, root: str, latencies: Latencies, scale: float,
+                 failure_rate: float = 0.0, seed: int = 0) -> None:
+        self.status_path = os.path.join(root, "dpkg_status")
+        self.latencies = latencies
+        self.scale = scale
+        self.failure_rate = failure_rate
+        self.snaps: Set[str] = set()
+        self.commands: List[str] = []
+        self._random = random.Random(seed)
+        self._dpkg_lock = threading.Lock()
+        self._lock = threading.Lock()
+        open(self.status_path, "w").close()
+
+    def _sleep(self, seconds: float) -> None:
+        time.sleep(seconds * self.scale)
+
+    def _fails(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def _mark_installed(self, pkgs: List[str]) -> None:
+        with self._lock, open(self.status_path, "a") as file:
+            for pkg in pkgs:
+                file.write(f"Package: {pkg}\nStatus: install ok installed\nVersion: 1.0\n\n")
+
+    def _apt(self, pkgs: List[str], update: bool = False) -> Tuple[int, bytes, bytes]:
+        if not self._dpkg_lock.acquire(blocking=False):
+            return 100, b"", b"E: Could not get lock /var/lib/dpkg/lock-frontend\n"
+        try:
+            if update:
+                self._sleep(self.latencies.apt_update)
+            else:
+                self._sleep(self.latencies.apt_transaction + self.latencies.apt_pkg * len(pkgs))
+            if self._fails():
+                return 100, b"", b"E: Failed to fetch from mirror\n"
+            self._mark_installed(pkgs)
+            return 0, b"Done\n", b""
+        finally:
+            self._dpkg_lock.release()
+
+    def __call__(self, cmd: str) -> Tuple[int, bytes, bytes]:
+        with self._lock:
+            self.commands.append(cmd)
+
+        if cmd == "apt-get update":
+            return self._apt([], update=True)
+        if cmd.startswith("apt-get install -y "):
+            # .deb files are named after their package
+            return self._apt([re.sub(r"^\./([^_]+)_.*", r"\1", arg) for arg in cmd.split()[3:]
+                              if not arg.startswith("-")])
+
+        if cmd == "snap list":
+            with self._lock:
+                rows = "".join(f"{name} 1.0 1 latest/stable publisher -\n" for name in sorted(self.snaps))
+            return 0, f"Name Version Rev Tracking Publisher Notes\n{rows}".encode(), b""
+        if cmd.startswith("snap install "):
+            self._sleep(self.latencies.snap_pkg)
+            if self._fails():
+                return 1, b"", b"error: cannot perform the following tasks:\n- Download snap (connection reset)\n"
+            with self._lock:
+                self.snaps.add(cmd.split()[2])
+            return 0, b"installed\n", b""
+
+        if cmd.startswith("git clone "):
+            self._sleep(self.latencies.git_clone)
+            os.makedirs(os.path.join(cmd.split()[-1], ".git"), exist_ok=True)
+            return 0, b"", f"Cloning into '{cmd.split()[-1]}'...\n".encode()
+        if cmd.startswith("mkdir -p "):
+            os.makedirs(cmd.split()[-1], exist_ok=True)
+            return 0, b"", b""
+
+        # repository registration, gpg, usermod, installer scripts...
+        self._sleep(self.latencies.command)
+        return 0, b"", b""
+
+
+class FakeResponse(io.BytesIO):
+    """Just enough of `http.client.HTTPResponse` for the cache and the downloader."""
+
+    def __init__(self, body: bytes) -> None:
+        super().__init__(body)
+        self.status = 200
+
+    def getheader(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return default
+
+
+def fake_key(seed: str) -> bytes:
+    """Returns a binary keyring holding an RSA public key made of random bytes, unique per `seed`."""
+
+    modulus = bytes([0x80]) + (hashlib.sha256(seed.encode()).digest() * 8)[1:]
+    body = (bytes([4]) + (0).to_bytes(4, "big") + bytes([1])
+            + (2048).to_bytes(2, "big") + modulus + (17).to_bytes(2, "big") + (65537).to_bytes(3, "big"))
+    # old format public key packet with a 2 bytes length
+    return bytes([0x99]) + len(body).to_bytes(2, "big") + body
+
+
+def fake_fingerprint(seed: str) -> str:
+    """Returns the fingerprint of `fake_key`."""
+
+    return keyring.fingerprints(fake_key(seed))[0]
+
+
+def fake_armored_key(seed: str) -> bytes:
+    """Returns `fake_key` in ASCII armor."""
+
+    key = fake_key(seed)
+    checksum = base64.b64encode(keyring.crc24(key).to_bytes(3, "big"))
+    return (b"-----BEGIN PGP PUBLIC KEY BLOCK-----\n\n" + base64.encodebytes(key)
+            + b"=" + checksum + b"\n-----END PGP PUBLIC KEY BLOCK-----\n")
+
+
+def fake_keys() -> Dict[str, bytes]:
+    """Returns a valid signing key for every repository of the manifest, and Launchpad's answer for ppas."""
+
+    bodies: Dict[str, bytes] = {}
+    for repo in installers.current_manifest().repos:
+        if repo.ppa:
+            fingerprint = fake_fingerprint(repo.name)
+            bodies[sources.launchpad_url(repo)] = json.dumps({"signing_key_fingerprint": fingerprint}).encode()
+            bodies[sources.keyserver_url(fingerprint)] = fake_armored_key(repo.name)
+        elif repo.key_url:
+            bodies[repo.key_url] = (fake_armored_key if repo.dearmor else fake_key)(repo.name)
+    return bodies
+
+
+class FakeHttpPool(fetch.HttpPool):
+    """Serves every url with a body of the simulated size after the simulated latency."""
+
+    def __init__(self, latencies: Latencies, scale: float) -> None:
+        super().__init__()
+        self.latencies = latencies
+        self.scale = scale
+        self.bodies = fake_keys()
+
+    @contextmanager
+    def open(self, url: str, headers: Optional[Dict[str, str]] = None) -> Iterator[FakeResponse]:
+        size = DOWNLOAD_SIZES.get(url, 0.1)
+        time.sleep((self.latencies.http_request + self.latencies.http_mib * size) * self.scale)
+        # the content only has to be unique per url, the size is simulated by the sleep
+        yield FakeResponse(self.bodies.get(url, url.encode()))
+
+
+@dataclass
+class Strategy:
+    """How much batching and parallelism a run uses."""
+
+    name: str
+    batch_apt: bool
+    snap_workers: int
+    install_workers: int
+    overlap_phases: bool = False                        # post-installation alongside the installation, as --all
+
+
+STRATEGIES = [
+    Strategy("serial", batch_apt=False, snap_workers=1, install_workers=1),
+    Strategy("batched", batch_apt=True, snap_workers=1, install_workers=1),
+    Strategy("parallel", batch_apt=True, snap_workers=installers.SNAP_MAX_WORKERS,
+             install_workers=main.INSTALL_MAX_WORKERS),
+    Strategy("overlapped", batch_apt=True, snap_workers=installers.SNAP_MAX_WORKERS,
+             install_workers=main.INSTALL_MAX_WORKERS, overlap_phases=True),
+]
+
+
+@contextmanager
+def sandbox(backend: FakeBackend, root: str, pool: fetch.HttpPool, strategy: Strategy) -> Iterator[None]:
+    """Points every path, backend and setting of the installers at the sandbox for one run."""
+
+    home = os.path.join(root, "home")
+    os.makedirs(home)
+    sources_dir = os.path.join(root, "sources.list.d")
+    os.makedirs(sources_dir)
+    os_release = os.path.join(root, "os-release")
+    with open(os_release, "w") as file:
+        file.write('NAME="Ubuntu"\nVERSION_CODENAME=focal\nUBUNTU_CODENAME=focal\n')
+    keyrings = os.path.join(root, "keyrings")
+    os.makedirs(keyrings)
+
+    patches = [
+        # the real ppa keys can not be faked, pin the fake ones instead
+        *((repo, "fingerprint", fake_fingerprint(repo.name))
+          for repo in installers.current_manifest().repos if repo.ppa),
+        (installers, "DOWNLOADS_PATH", os.path.join(root, "inst_downloads")),
+        (sources, "KEYRINGS_PATH", keyrings),
+        (sources, "SOURCES_PATH", sources_dir),
+        (sources, "OS_RELEASE_PATH", os_release),
+        (installers, "SNAP_MAX_WORKERS", strategy.snap_workers),
+        (apt, "BATCH_INSTALLS", strategy.batch_apt),
+        (journal, "JOURNAL_PATH", os.path.join(root, "journal.jsonl")),
+        (post_installers, "HOME_PATH", home),
+        (imgs, "PICS_DEST_PARENT", os.path.join(home, "Pictures/desk_custom")),
+        # backoff sleeps are real time, scale them like every simulated latency
+        (retry.NETWORK_RETRY, "base_delay", retry.NETWORK_RETRY.base_delay * backend.scale),
+        (retry.NETWORK_RETRY, "max_delay", retry.NETWORK_RETRY.max_delay * backend.scale),
+        (installers.SNAP_RETRY, "base_delay", installers.SNAP_RETRY.base_delay * backend.scale),
+        (installers.SNAP_RETRY, "max_delay", installers.SNAP_RETRY.max_delay * backend.scale),
+    ]
+    saved = [(module, name, getattr(module, name)) for module, name, _ in patches]
+    saved_pool = fetch.default_pool()
+
+    for module, name, value in patches:
+        setattr(module, name, value)
+    sources.host_release.cache_clear()
+    cli.set_executor(backend)
+    fetch.set_default_pool(pool)
+    cache.set_default_cache(cache.DownloadCache(os.path.join(root, "cache")))
+    pkg_index.set_package_index(pkg_index.PackageIndex(backend.status_path))
+
+    try:
+        yield
+    finally:
+        for module, name, value in saved:
+            setattr(module, name, value)
+        sources.host_release.cache_clear()
+        cli.set_executor(None)
+        fetch.set_default_pool(saved_pool)
+        cache.set_default_cache(None)
+        pkg_index.set_package_index(pkg_index.PackageIndex())
+
+
+def run_strategy(strategy: Strategy, latencies: Latencies, scale: float,
+                 failure_rate: float, seed: int) -> Tuple[float, bool, int]:
+    """Runs both phases end to end and returns the wall time, success and command count."""
+
+    with tempfile.TemporaryDirectory(prefix="apollo-bench-") as root:
+        backend = FakeBackend(root, latencies, scale, failure_rate, seed)
+        pool = FakeHttpPool(latencies, scale)
+        with sandbox(backend, root, pool, strategy), redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            if strategy.overlap_phases:
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    post_installation = executor.submit(main.main_post_installation)
+                    ok = main.main_installation(max_workers=strategy.install_workers)
+                    post_installation.result()
+            else:
+                ok = main.main_installation(max_workers=strategy.install_workers)
+                main.main_post_installation()
+            wall = time.perf_counter() - start
+
+    return wall, ok, len(backend.commands)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parses the command line options."""
+
+    parser = argparse.ArgumentParser(description="Benchmark the installer against simulated backends.")
+    parser.add_argument("--scale", type=float, default=0.01, help="multiplier applied to every latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="probability of any apt/snap command failing")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main_bench(argv: Optional[List[str]] = None) -> None:
+    """Runs every strategy and prints their wall times."""
+
+    args = parse_args(argv)
+    latencies = Latencies()
+
+    print(f"{'strategy':<10} {'wall (s)':>9} {'simulated (s)':>14} {'commands':>9}  result")
+    for strategy in STRATEGIES:
+        wall, ok, commands = run_strategy(strategy, latencies, args.scale, args.failure_rate, args.seed)
+        result = "ok" if ok else "failed"
+        print(f"{strategy.name:<10} {wall:>9.2f} {wall / args.scale:>14.1f} {commands:>9}  {result}")
+
+
+if __name__ == "__main__":
+
+    main_bench()
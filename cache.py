@@ -0,0 +1,260 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from http.client import HTTPException, HTTPResponse
+from pathlib import Path
+from shutil import copyfile
+from typing import Dict, List, Optional, Tuple
+from exceptions import DownloadError, HttpStatusError
+from fetch import CHUNK_SIZE, HttpPool, Progress, default_pool, download, save_response
+
+
+# point `APOLLO_CACHE_DIR` at a shared directory to reuse downloads across hosts
+CACHE_PATH = os.environ.get("APOLLO_CACHE_DIR", f"{Path.home()}/.cache/apollo")
+CACHE_MAX_BYTES = 2 * 1024 ** 3                         # blobs above this size get evicted, oldest first
+CACHE_FRESH_SECONDS = 60 * 60                           # entries checked this recently skip the network
+
+
+def sha256_file(path: str) -> str:
+    """Returns the hex SHA-256 digest of the file at `path`."""
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def entry_path(root: str, url: str) -> str:
+    """Returns where the index entry of `url` is stored in the cache at `root`."""
+
+    return os.path.join(root, "index", f"{hashlib.sha256(url.encode()).hexdigest()}.json")
+
+
+def cached_size(url: str, root: Optional[str] = None) -> Optional[int]:
+    """Returns the size of the last known content of `url`, without touching the cache.
+
+    `root` defaults to the shared cache's, without creating it.
+    """
+
+    if root is None:
+        root = _DEFAULT_CACHE.root if _DEFAULT_CACHE is not None else CACHE_PATH
+    try:
+        with open(entry_path(root, url)) as file:
+            digest = json.load(file)["sha256"]
+        return os.path.getsize(os.path.join(root, "blobs", digest))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class DownloadCache:
+    """Persistent, content-addressed cache for downloaded files.
+
+    Blobs are stored under their SHA-256 digest in `blobs/` and every url has an entry in
+    `index/` with the digest of its last known content and the `ETag`/`Last-Modified`
+    validators returned by the server. Stale entries are revalidated with a conditional
+    request, so unchanged artifacts are never downloaded twice. Every write goes through a
+    temporary file and a rename, which keeps the cache consistent when shared between hosts.
+    """
+
+    def __init__(self, root: str = CACHE_PATH, max_bytes: int = CACHE_MAX_BYTES,
+                 fresh_seconds: float = CACHE_FRESH_SECONDS) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.fresh_seconds = fresh_seconds
+        self._blobs = os.path.join(root, "blobs")
+        self._index = os.path.join(root, "index")
+        self._lock = threading.Lock()
+        os.makedirs(self._blobs, exist_ok=True)
+        os.makedirs(self._index, exist_ok=True)
+
+    def _entry_path(self, url: str) -> str:
+        return entry_path(self.root, url)
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self._blobs, digest)
+
+    def _load_entry(self, url: str) -> Optional[Dict]:
+        """Returns the index entry of `url` if its blob is present and complete.
+
+        Blobs are hashed as they are stored, a lookup only compares the recorded size. Entries
+        written before sizes were recorded are hashed instead.
+        """
+
+        try:
+            with open(self._entry_path(url)) as file:
+                entry = json.load(file)
+            blob = self._blob_path(entry.get("sha256", ""))
+            size = os.path.getsize(blob)
+        except (OSError, ValueError, AttributeError):
+            return None
+
+        if "size" in entry:
+            return entry if entry["size"] == size else None
+        return entry if sha256_file(blob) == entry["sha256"] else None
+
+    def _save_entry(self, url: str, entry: Dict) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self._index, prefix=".tmp-")
+        with os.fdopen(fd, "w") as file:
+            json.dump(entry, file)
+        os.replace(tmp, self._entry_path(url))
+
+    def _touch(self, digest: str) -> None:
+        """Marks a blob as recently used for the LRU eviction."""
+
+        try:
+            os.utime(self._blob_path(digest))
+        except OSError:
+            pass
+
+    def _download_path(self, url: str) -> str:
+        """Returns where a first download of `url` is written, stable so an interrupted one resumes."""
+
+        return os.path.join(self._blobs, f".dl-{hashlib.sha256(url.encode()).hexdigest()}")
+
+    def fetch(self, url: str, pool: Optional[HttpPool] = None, fresh_seconds: Optional[float] = None,
+              sha256: Optional[str] = None, progress: Optional[Progress] = None) -> str:
+        """Returns the path of the cached copy of `url`, downloading it only if it changed.
+
+        `fresh_seconds` overrides how long a copy is used without revalidating it. With `sha256`
+        a copy with another digest is never returned, and a download not matching it fails.
+        """
+
+        fresh_seconds = self.fresh_seconds if fresh_seconds is None else fresh_seconds
+        entry = self._load_entry(url)
+        if entry and sha256 and entry["sha256"] != sha256.lower():
+            entry = None
+        if entry and time.time() - entry.get("checked", 0) < fresh_seconds:
+            self._touch(entry["sha256"])
+            return self._blob_path(entry["sha256"])
+
+        pool = pool or default_pool()
+        if not entry:
+            result = download(url, self._download_path(url), pool, sha256, progress)
+            os.replace(result.path, self._blob_path(result.sha256))
+            entry = {
+                "url": url,
+                "sha256": result.sha256,
+                "size": result.size,
+                "etag": result.etag,
+                "last_modified": result.last_modified,
+            }
+            return self._record(url, entry)
+
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            with pool.open(url, headers) as resp:
+                if resp.status == 304:
+                    digest = entry["sha256"]
+                elif resp.status == 200:
+                    digest, size = self._store(resp, progress)
+                    if sha256 and digest != sha256.lower():
+                        raise DownloadError(f"Checksum mismatch for {url}: expected {sha256}, got {digest}.")
+                    entry = {
+                        "url": url,
+                        "sha256": digest,
+                        "size": size,
+                        "etag": resp.getheader("ETag"),
+                        "last_modified": resp.getheader("Last-Modified"),
+                    }
+                else:
+                    raise HttpStatusError(f"Could not fetch {url}: HTTP {resp.status}.", resp.status)
+        except DownloadError:
+            # a mirror outage should not matter when we still hold a verified copy
+            if entry:
+                print(f"Using cached copy of {url}.")
+                return self._blob_path(entry["sha256"])
+            raise
+
+        return self._record(url, entry)
+
+    def _record(self, url: str, entry: Dict) -> str:
+        """Saves the entry of a checked url and returns the path of its blob."""
+
+        entry["checked"] = time.time()
+        self._save_entry(url, entry)
+        self._touch(entry["sha256"])
+        self.evict(keep=[entry["sha256"]])
+
+        return self._blob_path(entry["sha256"])
+
+    def _store(self, resp: HTTPResponse, progress: Optional[Progress] = None) -> Tuple[str, int]:
+        """Streams a response body into the blob store and returns its digest and size."""
+
+        length = resp.getheader("Content-Length")
+        digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self._blobs, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                total = int(length) if length and length.isdigit() else None
+                size = save_response(resp, file, digest, total=total, progress=progress)
+            os.replace(tmp, self._blob_path(digest.hexdigest()))
+        except (OSError, HTTPException) as exc:
+            os.unlink(tmp)
+            raise DownloadError(f"Could not store download: {exc}")
+
+        return digest.hexdigest(), size
+
+    def evict(self, keep: Optional[List[str]] = None) -> None:
+        """Deletes the least recently used blobs until the cache fits in `max_bytes`."""
+
+        with self._lock:
+            blobs = []
+            for entry in os.scandir(self._blobs):
+                # skip downloads still being written
+                if entry.is_file() and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    blobs.append((stat.st_mtime, stat.st_size, entry.name))
+
+            total = sum(size for _, size, _ in blobs)
+            for _, size, name in sorted(blobs):
+                if total <= self.max_bytes:
+                    break
+                if keep and name in keep:
+                    continue
+                try:
+                    os.unlink(self._blob_path(name))
+                except OSError:
+                    continue
+                total -= size
+
+    def copy_to(self, url: str, dest: str, pool: Optional[HttpPool] = None, sha256: Optional[str] = None,
+                progress: Optional[Progress] = None) -> str:
+        """Places the cached copy of `url` at `dest`, see `fetch` for the other arguments."""
+
+        path = self.fetch(url, pool, sha256=sha256, progress=progress)
+        try:
+            copyfile(path, dest)
+        except OSError as exc:
+            raise DownloadError(f"Could not copy {url} to {dest}: {exc}")
+        return dest
+
+
+_DEFAULT_CACHE: Optional[DownloadCache] = None
+_DEFAULT_CACHE_LOCK = threading.Lock()
+
+
+def default_cache() -> DownloadCache:
+    """Returns the cache shared by the whole run, creating it on first use."""
+
+    global _DEFAULT_CACHE
+    with _DEFAULT_CACHE_LOCK:
+        if _DEFAULT_CACHE is None:
+            _DEFAULT_CACHE = DownloadCache()
+    return _DEFAULT_CACHE
+
+
+def set_default_cache(cache: Optional[DownloadCache]) -> None:
+    """Replaces the cache shared by the whole run, `None` creates a fresh one on next use."""
+
+    global _DEFAULT_CACHE
+    with _DEFAULT_CACHE_LOCK:
+        _DEFAULT_CACHE = cache
@@ -1,46 +1,436 @@
+import os
 import re
+import select
+import selectors
+import shlex
+import signal
 import subprocess as subp
-from typing import List, Optional, Tuple
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from shutil import which
+from typing import Callable, Deque, Dict, Iterator, List, Mapping, Optional, Sequence, Set, Tuple, Union
+from profiling import span
 
 
-def comm(cmd: str) -> Tuple[bytes, Optional[bytes]]:
-    """Executes a shell command using `subp.Popen` interface."""
+ERR_TAIL_LINES = 50                                     # stderr lines kept by a streamed command
+READ_SIZE = 8192
 
-    with subp.Popen(f"{cmd}", shell=True, stdout=subp.PIPE, stderr=subp.PIPE) as proc:
-        try:
-            outs, errs = proc.communicate()
-        except KeyboardInterrupt:
+# runs a shell command and returns its exit code, stdout and stderr
+Executor = Callable[[str], Tuple[int, bytes, bytes]]
+
+_EXECUTOR: Optional[Executor] = None
+
+# commands running right now with whether they lead their own process group, killed by `interrupt`
+_LIVE: Set[Tuple[subp.Popen, bool]] = set()
+_LIVE_LOCK = threading.Lock()
+_INTERRUPTED = threading.Event()
+
+
+def set_executor(executor: Optional[Executor]) -> None:
+    """Routes every command to `executor` instead of a shell, `None` restores the shell.
+
+    Used by the benchmarks to run the installers against simulated package managers.
+    """
+
+    global _EXECUTOR
+    _EXECUTOR = executor
+
+
+def current_executor() -> Optional[Executor]:
+    """Returns the executor set by `set_executor`, `None` when commands go to a shell."""
+
+    return _EXECUTOR
+
+
+def _kill(proc: subp.Popen, group: bool) -> None:
+    """Kills a command, and everything it spawned when it leads its own process group."""
+
+    if not group:
+        proc.kill()
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _track(proc: subp.Popen, group: bool) -> None:
+    """Registers a running command for `interrupt`, killing it right away if the run was interrupted."""
+
+    with _LIVE_LOCK:
+        _LIVE.add((proc, group))
+        if _INTERRUPTED.is_set():
+            _kill(proc, group)
+
+
+def _untrack(proc: subp.Popen, group: bool) -> None:
+    with _LIVE_LOCK:
+        _LIVE.discard((proc, group))
+
+
+def interrupt() -> None:
+    """Stops the run on Ctrl-C: kills every running command and makes the next ones raise `KeyboardInterrupt`.
+
+    Commands with a timeout lead their own process group, the terminal's SIGINT never reaches them.
+    """
+
+    with _LIVE_LOCK:
+        _INTERRUPTED.set()
+        for proc, group in _LIVE:
+            _kill(proc, group)
+
+
+def interrupted(timeout: float = 0) -> bool:
+    """Checks if the run was interrupted, waiting up to `timeout` seconds for it to happen."""
+
+    return _INTERRUPTED.wait(timeout) if timeout > 0 else _INTERRUPTED.is_set()
+
+
+def clear_interrupt() -> None:
+    """Lets commands run again after `interrupt`."""
+
+    _INTERRUPTED.clear()
+
+
+def _check_interrupt() -> None:
+    if _INTERRUPTED.is_set():
+        raise KeyboardInterrupt
+
+
+Argv = Sequence[str]
+
+
+def argv_text(argv: Argv) -> str:
+    """Returns `argv` as a shell command line, for logs and executors."""
+
+    return " ".join(shlex.quote(arg) for arg in argv)
+
+
+@dataclass
+class Stage:
+    """Outcome of one process of a pipeline."""
+
+    argv: List[str]
+    returncode: int
+    stderr: bytes
+    wall: float = 0.0                                   # seconds from the start of the pipeline until it exited
+
+
+@dataclass
+class RunResult:
+    """Outcome of `run` or `pipeline`, with the exit code of every stage."""
+
+    stdout: bytes
+    stages: List[Stage]
+
+    @property
+    def failed_stage(self) -> Optional[Stage]:
+        """Returns the first stage that exited with an error, the culprit of a failed pipeline.
+
+        A stage killed by SIGPIPE only means a later one stopped reading, which is not an error.
+        """
+
+        for stage in self.stages[:-1]:
+            if stage.returncode not in (0, -signal.SIGPIPE):
+                return stage
+        return self.stages[-1] if self.stages and self.stages[-1].returncode else None
+
+    @property
+    def ok(self) -> bool:
+        return self.failed_stage is None
+
+    @property
+    def returncode(self) -> int:
+        failed = self.failed_stage
+        return failed.returncode if failed else 0
+
+    @property
+    def stderr(self) -> bytes:
+        return b"".join(stage.stderr for stage in self.stages)
+
+
+def run(argv: Argv, *, cwd: Optional[str] = None, env: Optional[Mapping[str, str]] = None,
+        input: Optional[bytes] = None, timeout: Optional[float] = None) -> RunResult:
+    """Executes a single command without a shell, see `pipeline`."""
+
+    return pipeline([argv], cwd=cwd, env=env, input=input, timeout=timeout)
+
+
+def pipeline(stages: Sequence[Argv], *, cwd: Optional[str] = None, env: Optional[Mapping[str, str]] = None,
+             input: Optional[bytes] = None, timeout: Optional[float] = None) -> RunResult:
+    """Executes commands with the stdout of each one wired to the stdin of the next, without a shell.
+
+    `input` is fed to the first stage and `env` is added to the current environment. Every
+    stage keeps its own stderr and exit code. A stage that can not be started reports exit
+    code 127, like a shell would, and the stages after it are not run. Raises
+    `subp.TimeoutExpired` after `timeout` seconds, once every stage is killed.
+    """
+
+    _check_interrupt()
+    text = " | ".join(argv_text(argv) for argv in stages)
+    with span(text, "cmd") as current:
+        if _EXECUTOR is not None:
+            code, outs, errs = _EXECUTOR(text)
+            result = RunResult(outs, [Stage(["sh", "-c", text], code, errs)])
+        else:
+            result = _pipeline(stages, text, cwd, None if env is None else {**os.environ, **env}, input, timeout)
+        current.exit_code = result.returncode
+        current.out_bytes = len(result.stdout) + len(result.stderr)
+
+    # a command killed by `interrupt` exits with an error its caller must not act on
+    _check_interrupt()
+    return result
+
+
+def _pipeline(stages: Sequence[Argv], text: str, cwd: Optional[str], env: Optional[Dict[str, str]],
+              input: Optional[bytes], timeout: Optional[float]) -> RunResult:
+    # like a shell, a missing program is reported as exit code 127 instead of an exception
+    path = (env or os.environ).get("PATH")
+    for argv in stages:
+        if not which(argv[0], path=path):
+            return RunResult(b"", [Stage(list(argv), 127, f"{argv[0]}: command not found\n".encode())])
+
+    start = time.monotonic()
+    procs: List[subp.Popen] = []
+    try:
+        for argv in stages:
+            stdin = procs[-1].stdout if procs else (subp.PIPE if input is not None else subp.DEVNULL)
+            procs.append(subp.Popen(list(argv), stdin=stdin, stdout=subp.PIPE, stderr=subp.PIPE, cwd=cwd, env=env))
+            _track(procs[-1], False)
+            if len(procs) > 1:
+                # only the next stage reads it now, so the previous one gets SIGPIPE if it stops reading
+                procs[-2].stdout.close()
+        outs, errs, exited = _collect(procs, input, None if timeout is None else start + timeout, start)
+    except subp.TimeoutExpired:
+        for proc in procs:
+            proc.kill()
+        raise subp.TimeoutExpired(text, timeout)
+    except (KeyboardInterrupt, OSError):
+        for proc in procs:
             proc.kill()
-            raise KeyboardInterrupt from KeyboardInterrupt
+        raise
+    finally:
+        for proc in procs:
+            proc.wait()
+            _untrack(proc, False)
+
+    return RunResult(outs, [Stage(list(proc.args), proc.returncode, errs[i], exited.get(i, time.monotonic() - start))
+                            for i, proc in enumerate(procs)])
+
+
+def _collect(procs: List[subp.Popen], input: Optional[bytes], deadline: Optional[float],
+             start: float) -> Tuple[bytes, List[bytes], Dict[int, float]]:
+    """Feeds `input` to the first process while reading the last one's stdout and every stderr.
+
+    Returns the stdout, the stderr of every process and when each stderr closed, which is
+    when its process exited.
+    """
+
+    sel = selectors.DefaultSelector()
+    outs: List[bytes] = []
+    errs: List[List[bytes]] = [[] for _ in procs]
+    exited: Dict[int, float] = {}
+
+    if procs:
+        sel.register(procs[-1].stdout, selectors.EVENT_READ, "out")
+        for i, proc in enumerate(procs):
+            sel.register(proc.stderr, selectors.EVENT_READ, i)
+        if input is not None:
+            sel.register(procs[0].stdin, selectors.EVENT_WRITE, "in")
+    pending = memoryview(input or b"")
+
+    while sel.get_map():
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            sel.close()
+            raise subp.TimeoutExpired(procs[0].args, deadline - start)
+        for key, _ in sel.select(remaining):
+            if key.data == "in":
+                try:
+                    written = os.write(key.fd, pending[:select.PIPE_BUF])
+                except BrokenPipeError:
+                    written = len(pending)
+                pending = pending[written:]
+                if not pending:
+                    sel.unregister(key.fileobj)
+                    key.fileobj.close()
+                continue
+
+            chunk = os.read(key.fd, READ_SIZE)
+            if not chunk:
+                sel.unregister(key.fileobj)
+                if key.data != "out":
+                    exited[key.data] = time.monotonic() - start
+            elif key.data == "out":
+                outs.append(chunk)
+            else:
+                errs[key.data].append(chunk)
+
+    sel.close()
+    return b"".join(outs), [b"".join(chunks) for chunks in errs], exited
+
+
+class StreamedCommand:
+    """Runs a command and yields its output line by line while it is running.
+
+    `cmd` is either an argv list or a shell command line. Iterating yields `(stream, line)`
+    tuples, with `stream` being either "out" or "err". Nothing is buffered besides the line
+    being read and the last `err_lines` lines of stderr, which stay available in `err_tail`
+    for error reporting once the command exits.
+    """
+
+    def __init__(self, cmd: Union[str, Argv], err_lines: int = ERR_TAIL_LINES,
+                 timeout: Optional[float] = None) -> None:
+        self.cmd = cmd if isinstance(cmd, str) else argv_text(cmd)
+        self.args = cmd if isinstance(cmd, str) else list(cmd)
+        self.timeout = timeout
+        self.returncode: Optional[int] = None
+        self.err_tail: Deque[bytes] = deque(maxlen=err_lines)
+
+    def __iter__(self) -> Iterator[Tuple[str, bytes]]:
+        _check_interrupt()
+        if _EXECUTOR is not None:
+            yield from self._execute(_EXECUTOR)
+            return
+
+        group = self.timeout is not None
+        with span(self.cmd, "cmd") as current, \
+                subp.Popen(self.args, shell=isinstance(self.args, str), stdout=subp.PIPE, stderr=subp.PIPE,
+                           start_new_session=group) as proc:
+            _track(proc, group)
+            try:
+                for stream, line in self._read(proc):
+                    current.out_bytes += len(line) + 1
+                    yield stream, line
+                self.returncode = current.exit_code = proc.wait()
+            except (KeyboardInterrupt, GeneratorExit, subp.TimeoutExpired):
+                _kill(proc, group)
+                raise
+            finally:
+                _untrack(proc, group)
+        _check_interrupt()
+
+    def _execute(self, executor: Executor) -> Iterator[Tuple[str, bytes]]:
+        """Replays the output of a command run by a custom executor."""
+
+        with span(self.cmd, "cmd") as current:
+            code, outs, errs = executor(self.cmd)
+            current.exit_code = self.returncode = code
+            current.out_bytes = len(outs) + len(errs)
+        for line in outs.splitlines():
+            yield "out", line
+        for line in errs.splitlines():
+            self.err_tail.append(line)
+            yield "err", line
+
+    def _read(self, proc: subp.Popen) -> Iterator[Tuple[str, bytes]]:
+        sel = selectors.DefaultSelector()
+        sel.register(proc.stdout, selectors.EVENT_READ, "out")
+        sel.register(proc.stderr, selectors.EVENT_READ, "err")
+        partial = {"out": b"", "err": b""}
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+
+        while sel.get_map():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                sel.close()
+                raise subp.TimeoutExpired(self.cmd, self.timeout)
+            for key, _ in sel.select(remaining):
+                name = key.data
+                chunk = os.read(key.fd, READ_SIZE)
+                if not chunk:
+                    sel.unregister(key.fileobj)
+                    lines = [partial[name]] if partial[name] else []
+                else:
+                    *lines, partial[name] = (partial[name] + chunk).split(b"\n")
+                for line in lines:
+                    if name == "err":
+                        self.err_tail.append(line)
+                    yield name, line
+
+        sel.close()
+
+    def errs(self) -> bytes:
+        """Returns the stderr lines kept in the tail."""
+
+        return b"".join(line + b"\n" for line in self.err_tail)
+
+
+def comm_live(cmd: Union[str, Argv], label: str = "", timeout: Optional[float] = None) -> Tuple[int, bytes]:
+    """Executes a command (see `StreamedCommand`) forwarding its output as it arrives.
+
+    Returns the exit code and the tail of stderr. Raises `subp.TimeoutExpired` once the command ran
+    for `timeout` seconds, after killing it.
+    """
+
+    prefix = f"[{label}] " if label else ""
+    proc = StreamedCommand(cmd, timeout=timeout)
+    for _, line in proc:
+        print(f"{prefix}{line.decode(errors='replace')}", flush=True)
+
+    return proc.returncode or 0, proc.errs()
+
+
+BENIGN = "benign"
+WARNING = "warning"
+FATAL = "fatal"
+
+# known stderr lines, matched from the start of each line, first match wins
+STDERR_PATTERNS: List[Tuple[str, bytes]] = [
+    (BENIGN, rb"WARNING: apt does not have a stable CLI interface\. Use with caution in scripts\."),
+    (BENIGN, rb"Cloning into '.*'\.\.\."),
+    (BENIGN, rb"debconf: (unable to initialize frontend|falling back to frontend|delaying package configuration)"),
+    (BENIGN, rb"dpkg-preconfigure: unable to re-open stdin"),
+    (BENIGN, rb"(Extracting templates from packages|Preconfiguring packages)"),
+    (WARNING, rb"[WN]: "),
+    (WARNING, rb"(WARNING|Warning|warning): "),
+    (FATAL, rb"E: "),
+]
+
+# a single alternation with one named group per pattern, so every line is matched once
+_STDERR_CLASSIFIER = re.compile(b"|".join(
+    b"(?P<p%d>%s)" % (i, patt) for i, (_, patt) in enumerate(STDERR_PATTERNS)
+))
+
+
+@dataclass
+class StderrReport:
+    """Lines of a command's stderr, split by how much they matter."""
+
+    benign: List[bytes] = field(default_factory=list)
+    warnings: List[bytes] = field(default_factory=list)
+    fatal: List[bytes] = field(default_factory=list)
 
-    return outs, errs
+    @property
+    def is_fatal(self) -> bool:
+        """Tells if stderr holds anything besides benign noise and warnings."""
 
+        return bool(self.fatal)
 
-def cmd_concat(cmds: List[str]) -> str:
-    """Concatenates cli commands with the `&&` operator."""
 
-    return " && ".join(cmds)
+def classify_stderr(errs: Optional[bytes]) -> StderrReport:
+    """Sorts every stderr line into benign, warning or fatal in a single pass.
 
+    Lines that match none of `STDERR_PATTERNS` are considered fatal.
+    """
 
-def car_expected_err_msg(msg: bytes, errs: bytes) -> Optional[bytes]:
-    """Captures an expected error message and removes it from an error bytes object."""
-    
-    if msg in errs:
-        s_msg = msg.decode()
-        s_errs = errs.decode()
-        patt = re.compile(s_msg)
-        # search will not return None because we already know the warning is in errs
-        res = patt.search(s_errs).span()
-        tmp_subs = s_errs[res[0]:res[1]]
-        s_errs = s_errs.replace(tmp_subs, "")
-        errs_ = bytes(s_errs, "utf8")
-        errs = car_expected_err_msg(msg, errs_)
-    
-    return errs
+    report = StderrReport()
+    if not errs:
+        return report
 
+    for line in errs.splitlines():
+        if not line.strip():
+            continue
+        match = _STDERR_CLASSIFIER.match(line)
+        severity = STDERR_PATTERNS[int(match.lastgroup[1:])][0] if match else FATAL
+        if severity == BENIGN:
+            report.benign.append(line)
+        elif severity == WARNING:
+            report.warnings.append(line)
+        else:
+            report.fatal.append(line)
 
-def car_apt_warning(errs: bytes) -> Optional[bytes]:
-    """Capture and remove apt cli constant warning and removes it from an error bytes object."""
+    return report
 
-    warning = b"\nWARNING: apt does not have a stable CLI interface. Use with caution in scripts.\n\n"
-    return car_expected_err_msg(warning, errs)
@@ -17,3 +17,36 @@ class UnexistentPathError(Exception):
     """Raised when a path to a specific directory does not exist."""
     pass
 
+
+
+class SchedulerError(Exception):
+    """Raised when a task graph can not be scheduled or one of its tasks was skipped."""
+    pass
+
+
+class DownloadError(Exception):
+    """Raised when a file could not be fetched over HTTP."""
+    pass
+
+
+class HttpStatusError(DownloadError):
+    """Raised when a server answered with an unexpected HTTP status, kept in `status`."""
+
+    def __init__(self, message: str, status: int) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class ManifestError(Exception):
+    """Raised when a manifest file can not be read or is invalid."""
+    pass
+
+
+class FleetError(Exception):
+    """Raised when a fleet inventory can not be read or is invalid."""
+    pass
+
+
+class KeyringError(Exception):
+    """Raised when a signing key is not a valid OpenPGP public key."""
+    pass
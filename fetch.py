@@ -0,0 +1,263 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+from exceptions import DownloadError, HttpStatusError
+
+
+CHUNK_SIZE = 64 * 1024                                  # bytes read from a response at a time
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+USER_AGENT = "apollo"
+
+PoolKey = Tuple[str, str, Optional[int]]
+Progress = Callable[[int, Optional[int]], None]         # bytes received so far, total size if known
+
+
+class HttpPool:
+    """Keeps HTTP(S) connections alive and reuses them for every request to the same host.
+
+    Safe to share between threads: a connection is only ever handed to one request at a time.
+    """
+
+    def __init__(self, timeout: float = 30.0, max_redirects: int = 5, proxy: str = "") -> None:
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.proxy = proxy.rstrip("/")                  # an apollo proxy every url is fetched through
+        self._idle: Dict[PoolKey, List[HTTPConnection]] = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, key: PoolKey) -> Tuple[HTTPConnection, bool]:
+        """Returns an idle connection to `key`, or a new one. The flag tells if it was reused."""
+
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+
+        scheme, host, port = key
+        if scheme == "https":
+            return HTTPSConnection(host, port, timeout=self.timeout), False
+        if scheme == "http":
+            return HTTPConnection(host, port, timeout=self.timeout), False
+        raise DownloadError(f"Unsupported url scheme {scheme}.")
+
+    def _release(self, key: PoolKey, conn: HTTPConnection, resp: HTTPResponse) -> None:
+        """Puts `conn` back in the pool if the server allows it to be reused."""
+
+        if resp.will_close or not resp.isclosed():
+            conn.close()
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def _send(self, key: PoolKey, path: str, headers: Dict[str, str]) -> Tuple[HTTPConnection, HTTPResponse]:
+        """Sends a GET request, retrying once on a fresh connection if a kept-alive one went stale."""
+
+        conn, reused = self._acquire(key)
+        try:
+            conn.request("GET", path, headers=headers)
+            return conn, conn.getresponse()
+        except (OSError, HTTPException) as exc:
+            conn.close()
+            if not reused:
+                raise DownloadError(f"Request to {key[1]} failed: {exc}")
+
+        return self._send(key, path, headers)
+
+    @contextmanager
+    def open(self, url: str, headers: Optional[Dict[str, str]] = None) -> Iterator[HTTPResponse]:
+        """Opens `url` following redirects and yields the final response."""
+
+        if self.proxy:
+            # the proxy follows redirects itself and caches the final content
+            url = f"{self.proxy}/{url}"
+        for _ in range(self.max_redirects + 1):
+            parts = urlsplit(url)
+            key = (parts.scheme, parts.hostname or "", parts.port)
+            path = parts.path or "/"
+            if parts.query:
+                path = f"{path}?{parts.query}"
+
+            conn, resp = self._send(key, path, {"User-Agent": USER_AGENT, **(headers or {})})
+
+            location = resp.getheader("Location")
+            if resp.status in REDIRECT_CODES and location:
+                resp.read()
+                self._release(key, conn, resp)
+                url = urljoin(url, location)
+                continue
+
+            try:
+                yield resp
+            finally:
+                self._release(key, conn, resp)
+            return
+
+        raise DownloadError(f"Too many redirects while fetching {url}.")
+
+    def close(self) -> None:
+        """Closes every idle connection."""
+
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+_DEFAULT_POOL = HttpPool()
+
+
+def default_pool() -> HttpPool:
+    """Returns the pool shared by the whole run."""
+
+    return _DEFAULT_POOL
+
+
+def set_default_pool(pool: HttpPool) -> None:
+    """Replaces the pool shared by the whole run, e.g. with a simulated network."""
+
+    global _DEFAULT_POOL
+    _DEFAULT_POOL = pool
+
+
+@dataclass
+class Download:
+    """A file fetched by `download`."""
+
+    path: str
+    sha256: str
+    size: int
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+def progress_printer(name: str, step: float = 0.1) -> Progress:
+    """Returns a progress callback printing how much of `name` arrived, every `step` of its size."""
+
+    state = {"next": step}
+
+    def report(done: int, total: Optional[int]) -> None:
+        if not total or done / total < state["next"]:
+            return
+        print(f"{name}: {done / total:.0%} of {total / 1024 ** 2:.1f} MiB")
+        state["next"] = (int(done / total / step) + 1) * step
+
+    return report
+
+
+def save_response(resp: HTTPResponse, file: BinaryIO, digest: "hashlib._Hash", done: int = 0,
+                  total: Optional[int] = None, progress: Optional[Progress] = None) -> int:
+    """Streams a response body to `file` one chunk at a time, hashing it on the way.
+
+    Returns the number of bytes in `file`, `done` being how many it held already.
+    """
+
+    for chunk in iter(lambda: resp.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+        file.write(chunk)
+        done += len(chunk)
+        if progress:
+            progress(done, total)
+    return done
+
+
+def _resume_state(part: str) -> Tuple[int, Optional[str]]:
+    """Returns the size of a partial download and the validator of the content it belongs to."""
+
+    try:
+        with open(f"{part}.json") as file:
+            validator = json.load(file).get("validator")
+        return os.path.getsize(part), validator
+    except (OSError, ValueError, AttributeError):
+        return 0, None
+
+
+def _range_start(resp: HTTPResponse) -> int:
+    match = re.match(r"bytes (\d+)-", resp.getheader("Content-Range") or "")
+    return int(match.group(1)) if match else -1
+
+
+def _discard(part: str) -> None:
+    """Removes a partial download and its resume state."""
+
+    for path in (part, f"{part}.json"):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _receive(url: str, resp: HTTPResponse, part: str, offset: int, digest: "hashlib._Hash",
+             progress: Optional[Progress]) -> Download:
+    """Writes the body of `resp` to `part`, after the `offset` bytes it already holds if it resumes."""
+
+    if resp.status == 206 and offset:
+        with open(part, "rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        mode = "ab"
+    elif resp.status == 200:
+        offset, mode = 0, "wb"
+    else:
+        raise HttpStatusError(f"Could not fetch {url}: HTTP {resp.status}.", resp.status)
+
+    length = resp.getheader("Content-Length")
+    total = offset + int(length) if length and length.isdigit() else None
+    etag, last_modified = resp.getheader("ETag"), resp.getheader("Last-Modified")
+    # If-Range only accepts strong validators
+    validator = etag if etag and not etag.startswith("W/") else last_modified
+
+    try:
+        if mode == "wb":
+            with open(f"{part}.json", "w") as file:
+                json.dump({"url": url, "validator": validator}, file)
+        with open(part, mode) as file:
+            size = save_response(resp, file, digest, offset, total, progress)
+    except (OSError, HTTPException) as exc:
+        raise DownloadError(f"Download of {url} was interrupted, the next attempt resumes it: {exc}")
+
+    if total is not None and size != total:
+        raise DownloadError(f"Download of {url} stopped at {size} of {total} bytes, the next attempt resumes it.")
+    return Download(part, digest.hexdigest(), size, etag, last_modified)
+
+
+def download(url: str, dest: str, pool: Optional[HttpPool] = None, sha256: Optional[str] = None,
+             progress: Optional[Progress] = None) -> Download:
+    """Streams `url` into the `dest` file.
+
+    The body is written to `dest.part`, which survives an interrupted attempt: the next call
+    only asks for the missing bytes with a `Range` request, guarded by `If-Range` so a file
+    that changed upstream in the meantime is fetched whole again. A partial file the server
+    can not resume (416, or a range starting elsewhere) is dropped for a full request. The
+    SHA-256 is computed as the bytes arrive and checked against `sha256`, if given, before
+    `dest` is put in place.
+    """
+
+    pool = pool or default_pool()
+    part = f"{dest}.part"
+    offset, validator = _resume_state(part)
+    headers = {"Range": f"bytes={offset}-", "If-Range": validator} if offset and validator else {}
+
+    with pool.open(url, headers) as resp:
+        stale = bool(headers) and resp.status in (206, 416) and _range_start(resp) != offset
+        if not stale:
+            result = _receive(url, resp, part, offset, hashlib.sha256(), progress)
+    if stale:
+        _discard(part)
+        return download(url, dest, pool, sha256, progress)
+
+    if sha256 and result.sha256 != sha256.lower():
+        _discard(part)
+        raise DownloadError(f"Checksum mismatch for {url}: expected {sha256}, got {result.sha256}.")
+
+    os.replace(part, dest)
+    os.unlink(f"{part}.json")
+    result.path = dest
+    return result
@@ -0,0 +1,225 @@
+import os
+import shlex
+import shutil
+import subprocess as subp
+import tarfile
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, List, Optional, Tuple
+from exceptions import FleetError, ManifestError
+from manifest import parse_toml
+from profiling import span
+
+
+FLEET_MAX_WORKERS = 10                                  # hosts provisioned at the same time
+FLEET_LOGS_PATH = f"{Path.cwd()}/fleet_logs"
+REMOTE_DIR = "apollo"                                   # where the installer is copied, relative to the remote home
+PUSH_EXCLUDES = {".git", "inst_downloads", "fleet_logs", "__pycache__", "apollo_journal.jsonl"}
+SSH_OPTIONS = ["-o", "BatchMode=yes", "-o", "ConnectTimeout=10"]
+
+
+@dataclass
+class Host:
+    """A machine of the inventory."""
+
+    name: str
+    address: str
+    user: str = ""
+    port: int = 22
+    manifest: str = ""                                  # relative to the installer, the default one if empty
+
+    @property
+    def target(self) -> str:
+        return f"{self.user}@{self.address}" if self.user else self.address
+
+
+@dataclass
+class HostResult:
+    """Outcome of provisioning a single host."""
+
+    host: str
+    ok: bool
+    seconds: float
+    log_path: str
+    failed_phase: str = ""
+    exit_code: Optional[int] = None
+
+
+def load_inventory(path: str) -> List[Host]:
+    """Reads the `[[host]]` tables of a TOML inventory file."""
+
+    try:
+        with open(path, "rb") as file:
+            data = parse_toml(file.read().decode("utf8"))
+    except (OSError, ManifestError) as exc:
+        raise FleetError(f"Could not read inventory {path}: {exc}")
+
+    hosts: List[Host] = []
+    for entry in data.get("host", []):
+        try:
+            hosts.append(Host(**entry))
+        except TypeError as exc:
+            raise FleetError(f"Invalid host entry in {path}: {exc}")
+
+    names = [host.name for host in hosts]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise FleetError(f"Duplicate hosts in {path}: {', '.join(duplicates)}.")
+    if not hosts:
+        raise FleetError(f"No hosts in {path}.")
+    return hosts
+
+
+def _push_filter(info: tarfile.TarInfo) -> Optional[tarfile.TarInfo]:
+    return None if PUSH_EXCLUDES & set(Path(info.name).parts) else info
+
+
+class Transport(ABC):
+    """How the installer reaches a host: copying it over and running commands there."""
+
+    @abstractmethod
+    def push(self, host: Host, src: str, log: BinaryIO) -> int:
+        """Copies the installer at `src` to the host and returns an exit code."""
+
+    @abstractmethod
+    def run(self, host: Host, cmd: str, log: BinaryIO, timeout: Optional[float] = None) -> int:
+        """Runs the shell command `cmd` from the installer's directory on the host, logging its output."""
+
+
+class SshTransport(Transport):
+    """Runs everything through `ssh`, which must log in without prompting (keys, agent)."""
+
+    def __init__(self, options: Optional[List[str]] = None) -> None:
+        self.options = SSH_OPTIONS if options is None else options
+
+    def _ssh(self, host: Host, remote_cmd: str) -> List[str]:
+        return ["ssh", *self.options, "-p", str(host.port), host.target, remote_cmd]
+
+    def push(self, host: Host, src: str, log: BinaryIO) -> int:
+        # the tarball is streamed straight into the remote `tar`, nothing is written locally
+        remote_cmd = f"mkdir -p {REMOTE_DIR} && tar -xf - -C {REMOTE_DIR}"
+        with subp.Popen(self._ssh(host, remote_cmd), stdin=subp.PIPE, stdout=log, stderr=subp.STDOUT) as proc:
+            try:
+                with tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+                    tar.add(src, arcname=".", filter=_push_filter)
+            except BrokenPipeError:
+                pass
+            finally:
+                proc.stdin.close()
+            return proc.wait()
+
+    def run(self, host: Host, cmd: str, log: BinaryIO, timeout: Optional[float] = None) -> int:
+        remote_cmd = f"cd {REMOTE_DIR} && {cmd}"
+        with subp.Popen(self._ssh(host, remote_cmd), stdin=subp.DEVNULL, stdout=log, stderr=subp.STDOUT) as proc:
+            try:
+                return proc.wait(timeout)
+            except (KeyboardInterrupt, subp.TimeoutExpired):
+                proc.kill()
+                raise
+
+
+class LocalTransport(Transport):
+    """Stands in for ssh with a directory per host under `root`, commands run as local subprocesses."""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def host_dir(self, host: Host) -> str:
+        return os.path.join(self.root, host.name)
+
+    def push(self, host: Host, src: str, log: BinaryIO) -> int:
+        try:
+            shutil.copytree(src, self.host_dir(host), dirs_exist_ok=True,
+                            ignore=lambda _, names: [name for name in names if name in PUSH_EXCLUDES])
+        except OSError as exc:
+            log.write(f"{exc}\n".encode())
+            return 1
+        return 0
+
+    def run(self, host: Host, cmd: str, log: BinaryIO, timeout: Optional[float] = None) -> int:
+        with subp.Popen(cmd, shell=True, cwd=self.host_dir(host), stdin=subp.DEVNULL,
+                        stdout=log, stderr=subp.STDOUT) as proc:
+            try:
+                return proc.wait(timeout)
+            except (KeyboardInterrupt, subp.TimeoutExpired):
+                proc.kill()
+                raise
+
+
+def installer_phases(host: Host) -> List[Tuple[str, str]]:
+    """Returns the commands installing a host, the post-installation runs as the ssh user alongside."""
+
+    args = f" --manifest {shlex.quote(host.manifest)}" if host.manifest else ""
+    # `-n` fails instead of hanging on a password prompt nobody can answer
+    return [("install", f"sudo -n python3 main.py --all{args}")]
+
+
+def provision_host(host: Host, transport: Transport, src: str, logs_path: str,
+                   phases: Optional[List[Tuple[str, str]]] = None,
+                   timeout: Optional[float] = None) -> HostResult:
+    """Pushes the installer to a host and runs its phases in order, stopping at the first failing one."""
+
+    log_path = os.path.join(logs_path, f"{host.name}.log")
+    start = time.perf_counter()
+    steps = [("push", "")] + (installer_phases(host) if phases is None else phases)
+
+    with open(log_path, "wb") as log, span(host.name, "step"):
+        for phase, cmd in steps:
+            log.write(f"==> {phase} {cmd}\n".encode())
+            log.flush()
+            try:
+                code = transport.push(host, src, log) if phase == "push" else transport.run(host, cmd, log, timeout)
+            except subp.TimeoutExpired:
+                log.write(f"==> {phase} timed out after {timeout}s\n".encode())
+                code = None
+            except OSError as exc:
+                log.write(f"==> {phase} could not run: {exc}\n".encode())
+                code = None
+            if code != 0:
+                return HostResult(host.name, False, time.perf_counter() - start, log_path, phase, code)
+
+    return HostResult(host.name, True, time.perf_counter() - start, log_path)
+
+
+def run_fleet(hosts: List[Host], transport: Transport, src: Optional[str] = None,
+              max_workers: int = FLEET_MAX_WORKERS, logs_path: Optional[str] = None,
+              phases: Optional[List[Tuple[str, str]]] = None,
+              timeout: Optional[float] = None) -> List[HostResult]:
+    """Provisions every host, at most `max_workers` at a time.
+
+    Hosts are independent, so the whole rollout takes about as long as the slowest host
+    as long as `max_workers` covers the fleet. Output of each host goes to its own log.
+    """
+
+    src = src or os.path.dirname(os.path.abspath(__file__))
+    logs_path = logs_path or FLEET_LOGS_PATH
+    os.makedirs(logs_path, exist_ok=True)
+    results: List[HostResult] = []
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = {pool.submit(provision_host, host, transport, src, logs_path, phases, timeout): host
+                   for host in hosts}
+        for future in as_completed(futures):
+            result = future.result()
+            status = "done" if result.ok else f"failed at {result.failed_phase}"
+            print(f"[{result.host}] {status} in {result.seconds:.1f}s")
+            results.append(result)
+
+    order = [host.name for host in hosts]
+    return sorted(results, key=lambda result: order.index(result.host))
+
+
+def fleet_summary(results: List[HostResult]) -> str:
+    """Returns the outcome of every host as a table, followed by the totals."""
+
+    lines = [f"{'host':<20} {'result':<24} {'time (s)':>9}  log"]
+    for result in results:
+        status = "ok" if result.ok else f"failed at {result.failed_phase} ({result.exit_code})"
+        lines.append(f"{result.host:<20} {status:<24} {result.seconds:>9.1f}  {result.log_path}")
+
+    failed = sum(1 for result in results if not result.ok)
+    lines.append(f"{len(results) - failed} succeeded, {failed} failed.")
+    return "\n".join(lines)
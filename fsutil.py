@@ -0,0 +1,31 @@
+import os
+import tempfile
+
+
+def write_if_changed(path: str, data: bytes, mode: int = 0o644) -> bool:
+    """Atomically writes `data` to `path` unless it already holds it, returns whether it changed.
+
+    The content goes to a temporary file next to `path` renamed over it, so readers never see
+    a half written file. The temporary file is removed if anything fails.
+    """
+
+    try:
+        with open(path, "rb") as file:
+            if file.read() == data:
+                return False
+    except OSError:
+        pass
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return True
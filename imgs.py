@@ -1,7 +1,11 @@
-import os.path
-from cli import comm
-from exceptions import CliError, ImgDownloadError, UnexistentPathError
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+from exceptions import CliError, DownloadError, ImgDownloadError, UnexistentPathError
+from cache import default_cache
 from post_installers import HOME_PATH
+from profiling import profiled
+from retry import fetch_mirrors
 
 
 PROF_PIC_URL = "https://avatars.githubusercontent.com/u/66369315?v=4"
@@ -10,17 +14,32 @@ CODE_BGD_URL = "https://user-images.githubusercontent.com/66369315/146630747-d52
 PICS_DEST_PARENT = f"{HOME_PATH}/Pictures/desk_custom"
 
 
+def list_imgs() -> List[Tuple[str, str]]:
+    """Returns every image as `(url, destination path)` pairs."""
+
+    return [
+        (PROF_PIC_URL, f"{PICS_DEST_PARENT}/profilepic_jpeg"),
+        (WALLPPER_URL, f"{PICS_DEST_PARENT}/wallpaper.png"),
+        (CODE_BGD_URL, f"{PICS_DEST_PARENT}/code_bgd.png"),
+    ]
+
+
+@profiled
 def download_img(url: str, dest: str, output: str) -> bool:
     """Retreives an image from `url` and saves it in the `dest` directory with `output`."""
 
-    # dest is relative to `~/` directory
     if not os.path.exists(dest):
         raise UnexistentPathError(f"Path {dest} does not exists.")
 
-    cmd = f"curl -so ~/{dest}/{output} {url}"
-    _, errs = comm(cmd)
+    path = f"{dest}/{output}"
 
-    if errs:
+    # already fetched by a previous run
+    if os.path.isfile(path) and os.path.getsize(path):
+        return True
+
+    try:
+        fetch_mirrors([url], lambda mirror: default_cache().copy_to(mirror, path))
+    except DownloadError:
         raise ImgDownloadError(f"Could not fetch image from {url}")
     return True
 
@@ -49,23 +68,30 @@ def download_code_bgd() -> bool:
 def download_all_imgs() -> None:
     """Fetches all images used to customize desktop."""
 
-    cmd = f"mkdir {PICS_DEST_PARENT}"
-    _, errs = comm(cmd)
-    if errs:
-        raise CliError(f"Could not create {PICS_DEST_PARENT}")
-
-    try:
-        download_profile_pic()
-    except ImgDownloadError:
-        raise ImgDownloadError("Failed to download profile picture.")
-
     try:
-        download_wallpaper()
-    except ImgDownloadError:
-        raise ImgDownloadError("Failed to download wallpaper picture.")
-
-    try:
-        download_code_bgd()
-    except ImgDownloadError:
-        raise ImgDownloadError("Failed to download code background picture.")
+        os.makedirs(PICS_DEST_PARENT, exist_ok=True)
+    except OSError:
+        raise CliError(f"Could not create {PICS_DEST_PARENT}")
 
+    # the downloads share one pool of kept-alive connections, so they can run side by side
+    downloads = [
+        (download_profile_pic, "Failed to download profile picture."),
+        (download_wallpaper, "Failed to download wallpaper picture."),
+        (download_code_bgd, "Failed to download code background picture."),
+    ]
+
+    def fetch(func: Callable[[], bool], err_msg: str) -> str:
+        try:
+            func()
+        except ImgDownloadError:
+            return err_msg
+        return ""
+
+    with ThreadPoolExecutor(max_workers=len(downloads)) as pool:
+        results = list(pool.map(lambda args: fetch(*args), downloads))
+
+    failed: List[str] = [err_msg for err_msg in results if err_msg]
+    for err_msg in failed:
+        print(err_msg)
+    if failed:
+        raise ImgDownloadError(" ".join(failed))
@@ -1,409 +1,481 @@
+import asyncio
+import grp
+import os
+import pwd
+import re
+from functools import partial
 from pathlib import Path
-from shutil import which
-from subprocess import TimeoutExpired
-from typing import List
-from cli import car_apt_warning, comm
-from exceptions import InstallationError
+from shutil import rmtree, which
+from typing import List, Optional
+from aexec import NET, retry_run, to_thread
+from apt import apt_update, install_apt_batch, missing_apt_pkgs, proxy_options
+from cache import default_cache
+from cli import RunResult, run
+from exceptions import DownloadError, InstallationError, KeyringError
+from fetch import progress_printer
+from keyring import dearmor, fingerprints, write_keyring
+from manifest import Deb, Manifest, Repo, Script, load_manifest
+from pkg_index import package_index
+from retry import RetryPolicy, fetch_mirrors, retry_cmd
+from scheduler import DPKG_LOCK, Task
+from sources import key_urls, keyring_path, ppa_listed, signing_fingerprint, sources_path, write_sources
 
 
 CURRENT_PATH = Path.cwd()
 CONFIG_FILES_PATH = f"{CURRENT_PATH}/files"
 DOWNLOADS_PATH = f"{CURRENT_PATH}/inst_downloads"
+MANIFEST_PATH = f"{CURRENT_PATH}/manifests/default.toml"
+SNAP_MAX_WORKERS = 4                                    # concurrent `snap install` processes
+# no timeout: killing the snap client does not stop the install inside snapd
+SNAP_RETRY = RetryPolicy(timeout=None)
+# failures worth retrying, anything else (e.g. a missing --classic, an unknown snap) would fail the same way again
+SNAP_TRANSIENT_PATTERN = re.compile(rb"(?i)(cannot download|download snap|connection|timed? ?out|temporary failure"
+                                    rb"|no route to host|unexpected eof|change in progress|too many requests)")
+
+_MANIFEST: Optional[Manifest] = None
+
+
+def use_manifest(path: str) -> Manifest:
+    """Loads the manifest at `path` and installs what it lists from now on."""
+
+    global _MANIFEST
+    _MANIFEST = load_manifest(path)
+    return _MANIFEST
+
+
+def current_manifest() -> Manifest:
+    """Returns the manifest in use, loading `MANIFEST_PATH` on first use."""
+
+    if _MANIFEST is None:
+        return use_manifest(MANIFEST_PATH)
+    return _MANIFEST
 
 
 def list_apt_pkgs() -> List[str]:
     """Returns a list of apt packages to be installed."""
 
-    pkgs = [
-        # essential for development
-        "build-essential",
-        "python3-dev",
-        "pkg-config",
-
-        # needed for other software installation and/or they're simply useful
-        "apt-transport-https",
-        "cmake",
-        "curl",
-        "ca-certificates",
-        "gnupg",
-        "lsb-release",
-
-        "htop",                         # better than top
-        "mmv",                          # move/copy/append/link multiple files according to a set of wildcard patterns
-        "neovim",
-        "tmux",                         # terminal multiplexer
+    return current_manifest().apt
 
-    ]
 
-    return pkgs
+def list_snap_pkgs() -> List[str]:
+    """Returns a list of snap apps, with their flags."""
 
+    return [snap.spec() for snap in current_manifest().snaps]
 
-def list_snap_pkgs() -> List[str]:
-    """Returns a list of snap apps."""
-
-    pkgs = [
-        "bitwarden",
-        "jdownloader2",
-        "libreoffice",
-        "signal-desktop",
-        "spotify",
-        "vlc",
-
-        "sublime-text --classic",
-        "code --classic",
-    ]
 
-    return pkgs
+def list_repo_pkgs() -> List[str]:
+    """Returns a list of apt packages coming from third-party repositories."""
+
+    return current_manifest().repo_pkgs()
 
 
 def pre_install() -> bool:
     """Creates "downloads" directory to be used at any point during the installation and post-installation phase."""
 
-    cmd = f"mkdir {DOWNLOADS_PATH}"
-    _, errs = comm(cmd)
-    if errs:
+    try:
+        os.makedirs(DOWNLOADS_PATH, exist_ok=True)
+    except OSError:
         raise InstallationError("Failed pre-installation procedure.")
     return True
 
 
+def apt_pkgs_installed() -> bool:
+    """Checks if every apt package is already installed."""
+
+    return not missing_apt_pkgs(list_apt_pkgs())
+
+
 def install_apt_pkgs() -> bool:
     """Installs apt packages."""
 
     pkgs = list_apt_pkgs()
 
     print("Installing Apt packages...")
+    install_apt_batch(pkgs)
+    print("Apt packages successfully installed.")
+    return True
 
-    for pkg in pkgs:
-        print(f"Installing {pkg}...")
-        _, errs_ = comm(f"apt install -y {pkg}")
-        if errs_:
-            errs = car_apt_warning(errs_)
-            if errs:
-                raise InstallationError(f"Failed to install {pkg}.")
 
-    print("Apt packages successfully installed.")
+def missing_snap_pkgs() -> List[str]:
+    """Returns the snap packages (with their flags) that are not installed yet."""
+
+    return package_index().missing_snaps(list_snap_pkgs())
+
+
+def snap_pkgs_installed() -> bool:
+    """Checks if every snap package is already installed."""
+
+    return not missing_snap_pkgs()
+
+
+def snap_failure_transient(result: RunResult) -> bool:
+    """Checks if a failed `snap install` is worth another attempt."""
+
+    return bool(SNAP_TRANSIENT_PATTERN.search(result.stderr))
+
+
+def _snap_installed(pkg: str, result: RunResult) -> bool:
+    """Records the outcome of `snap install pkg`, raising `InstallationError` if it failed."""
+
+    if not result.ok:
+        print(result.stderr.decode(errors="replace").strip())
+        raise InstallationError(f"Failed to install {pkg}.")
+    package_index().add_snap(pkg.split()[0])
+    print(f"Successfully installed {pkg}.")
     return True
 
 
-def install_snap_pkgs() -> bool:
-    """Installs snap pkgs."""
+def snap_install_argv(pkg: str) -> List[str]:
+    """Returns the command installing the snap package `pkg`, flags included."""
+
+    return ["snap", "install", *pkg.split()]
+
 
-    pkgs_ = list_snap_pkgs()
-    install_cmd = "snap install "
+def install_snap_pkg(pkg: str) -> bool:
+    """Installs a single snap package, `pkg` may carry flags like `--classic`."""
 
-    # separate any package that needs the `--classic` flag
-    # for now it simply assumes that if there is a flag, it will be exactly the `--classic` flag
-    # fortunately, all the snap pkgs I need either don't need a flag or the flag is `--classic`. For now.
+    print(f"Installing {pkg}...")
+    result = retry_cmd(snap_install_argv(pkg), SNAP_RETRY, retry_if=snap_failure_transient)
+    return _snap_installed(pkg, result)
 
-    unflg_pkgs: List[str] = []
-    flg_pkgs: List[str] = []
-    flag = "--classic"
 
-    for pkg in pkgs_:
-        if flag in pkg:
-            flg_pkgs.append(pkg)
-        else:
-            unflg_pkgs.append(pkg)
+async def install_snap_pkg_async(pkg: str) -> bool:
+    """Asynchronous `install_snap_pkg`, the install shares the network slots of `aexec` with other downloads."""
+
+    print(f"Installing {pkg}...")
+    result = await retry_run(snap_install_argv(pkg), policy=SNAP_RETRY, retry_if=snap_failure_transient,
+                             resource=NET)
+    return _snap_installed(pkg, result)
+
+
+def _failures(names: List[str], results: List[object]) -> List[str]:
+    """Returns the names whose result is an `InstallationError`, re-raising any other exception."""
+
+    failed: List[str] = []
+    for name, result in zip(names, results):
+        if isinstance(result, InstallationError):
+            print(result)
+            failed.append(name)
+        elif isinstance(result, BaseException):
+            raise result
+    return failed
+
+
+async def install_snap_pkgs_async(max_workers: Optional[int] = None) -> bool:
+    """Installs snap pkgs concurrently, at most `max_workers` (`SNAP_MAX_WORKERS` by default) at a time.
+
+    Snap installs are dominated by the squashfs download, so running them side by side
+    makes the whole phase take about as long as the biggest package.
+    """
+
+    pkgs = await to_thread(missing_snap_pkgs)
+    slots = asyncio.Semaphore(max(1, max_workers or SNAP_MAX_WORKERS))
+
+    async def install(pkg: str) -> bool:
+        async with slots:
+            return await install_snap_pkg_async(pkg)
 
     print("Installing Snap packages...")
+    results = await asyncio.gather(*(install(pkg) for pkg in pkgs), return_exceptions=True)
+
+    failed = _failures(pkgs, results)
+    if failed:
+        raise InstallationError(f"Failed to install {', '.join(sorted(failed))}.")
 
-    for pkg in flg_pkgs:
-        print(f"Installing {pkg}...")
-        _, errs = comm(f"{install_cmd} {pkg}")
-        if errs:
-            raise InstallationError(f"Failed to install {pkg}.")
-
-    for pkg in unflg_pkgs:
-        print(f"Installing {pkg}...")
-        _, errs = comm(f"{install_cmd} {pkg}")
-        if errs:
-            raise InstallationError(f"Failed to install {pkg}.")
-    
     print("Snap packages were successfully installed.")
 
     return True
 
 
-def install_brave_browser() -> bool:
-    """Installs Brave Browser.
+def install_snap_pkgs(max_workers: Optional[int] = None) -> bool:
+    """Installs every missing snap package, see `install_snap_pkgs_async`."""
 
-    Installation instructions from <https://brave.com/linux/#linux>.
-    """
+    return asyncio.run(install_snap_pkgs_async(max_workers))
+
+
+def repo_added(repo: Repo) -> bool:
+    """Checks if the keyring and source entry of `repo` are in place."""
+
+    if repo.ppa and ppa_listed(repo):
+        return True
+    return os.path.isfile(keyring_path(repo)) and os.path.isfile(sources_path(repo))
+
+
+def add_repo(repo: Repo) -> bool:
+    """Adds the signing keys and source entry of a third-party apt repository, without running any command."""
+
+    print(f"Getting {repo.name}'s signing keys...")
+    try:
+        expected = signing_fingerprint(repo)
+        key_path = fetch_mirrors(key_urls(repo, expected), default_cache().fetch)
+        with open(key_path, "rb") as file:
+            key = file.read()
+        # decoded in-process, `gpg --dearmor` would set up a home directory and maybe start an agent
+        keys = dearmor(key) if repo.dearmor or repo.ppa else key
+        found = fingerprints(keys)
+        if expected and expected not in found:
+            raise KeyringError(f"expected key {expected}, got {', '.join(found)}")
+        write_keyring(keys, keyring_path(repo))
+    except (DownloadError, KeyringError, OSError) as exc:
+        print(exc)
+        raise InstallationError(f"Failed to add {repo.name}'s fingerprint.")
+    print(f"Successfully added {repo.name}'s signing keys ({', '.join(found)}).")
+
+    print(f"Adding {repo.name}'s apt repository...")
+    try:
+        write_sources(repo)
+    except OSError:
+        raise InstallationError(f"Failed to add {repo.name}'s apt repository.")
+    print(f"Successfully added {repo.name}'s apt repository.")
 
-    cmd = ("curl -fsSLo /usr/share/keyrings/brave-browser-archive-keyring.gpg "
-    "https://brave-browser-apt-release.s3.brave.com/brave-browser-archive-keyring.gpg"
-           )
-
-    print("Getting Brave Browser's signing keys...")
-    _, errs = comm(cmd)
-    if errs:
-        raise InstallationError("Failed to add Brave Browser's fingerprint.")
-    print("Successfully added Brave Browser's signing keys.")
-
-    cmd = ("echo "
-           "\"deb [signed-by=/usr/share/keyrings/brave-browser-archive-keyring.gpg arch=amd64] "
-           "https://brave-browser-apt-release.s3.brave.com/ stable main\""
-           " | "
-           "tee /etc/apt/sources.list.d/brave-browser-release.list"
-          )
-
-    print("Adding Brave Browser's apt repository...")
-    _, errs = comm(cmd)
-    if errs:
-        raise InstallationError("Failed to add Brave Browser's ppa.")
-    print("Successfully added Brave Browser's apt repository.")
-
-    cmd = "apt update -y && apt install -y brave-browser"
-
-    print("Installing brave-browser...")
-    _, errs_ = comm(cmd)
-    if errs_:
-        errs = car_apt_warning(errs_)
-        if errs:
-            raise InstallationError("Failed to install Brave Browser's apt package.")
-    print("Installation successful.")
     return True
 
 
-def install_docker() -> bool:
-    """Installs Docker Engine and Docker Compose v2.
+def repos_added() -> bool:
+    """Checks if the keyring and source entry of every third-party repository are in place."""
+
+    return all(repo_added(repo) for repo in current_manifest().repos)
+
+
+def repo_pkgs_installed() -> bool:
+    """Checks if every third-party apt package is already installed."""
 
-    Installation instructions from <https://docs.docker.com/engine/install/ubuntu/> and
-    <https://docs.docker.com/engine/install/linux-postinstall/>
+    return not missing_apt_pkgs(list_repo_pkgs())
+
+
+async def add_repo_async(repo: Repo) -> bool:
+    """Asynchronous `add_repo`, keys are fetched in a worker thread.
+
+    Registering a repository runs no command, the HTTP requests of `cache` are blocking.
     """
 
-    cmd = ("curl -fsSL https://download.docker.com/linux/ubuntu/gpg"
-           " | "
-           "gpg --dearmor -o /usr/share/keyrings/docker-archive-keyring.gpg"
-          )
-
-    print("Adding Docker signing keys...")
-    _, errs = comm(cmd)
-    if errs:
-        raise InstallationError("Failed to add Docker's fingerprint.")
-    print("Successfully added Docker's signing keys.")
-
-    cmd = ("echo "
-           "\"deb [arch=$(dpkg --print-architecture) signed-by=/usr/share/keyrings/docker-archive-keyring.gpg] "
-           "https://download.docker.com/linux/ubuntu "
-           "$(lsb_release -cs) stable\""
-           " | "
-           "tee /etc/apt/sources.list.d/docker.list > /dev/null"
-           )
-
-    print("Adding Docker apt repository...")
-    _, errs = comm(cmd)
-    if errs:
-        raise InstallationError("Failed to add Docker's ppa.")
-    print("Docker's apt repository successfully added.")
-
-    print("Updating apt repositories...")
-    cmd = "apt update -y"
-    _, errs_ = comm(cmd)
-    if errs_:
-        errs = car_apt_warning(errs_)
-        if errs:
-            raise InstallationError("Failed to install Docker apt packages.")
-    print("Apt repositories successfully updated.")
-
-    pkgs = ["docker-ce", "docker-ce-cli", "containerd.io"]
-    for pkg in pkgs:
-        print(f"Installing {pkg}...")
-        _, errs_ = comm(f"apt install -y {pkg}")
-        if errs_:
-            errs = car_apt_warning(errs_)
-            if errs:
-                raise InstallationError(f"Failed to install Docker {pkg}.")
-    print("Installation successful.")
+    return await to_thread(add_repo, repo)
 
-    # post-install step required for all Linux distros
 
-    cmd = "usermod -aG docker $USER"
-    print("Adding user to docker group...")
-    _, errs = comm(cmd)
-    if errs:
-        print(errs)
-        raise InstallationError("Failed to add user to docker group.")
-    print("Successfully added user to Docker group")
+async def add_repos_async() -> bool:
+    """Registers every missing third-party repository concurrently.
+
+    Each one is mostly waiting on a key server or Launchpad, so they overlap well.
+    """
+
+    repos = [repo for repo in current_manifest().repos if not repo_added(repo)]
+    results = await asyncio.gather(*(add_repo_async(repo) for repo in repos), return_exceptions=True)
+
+    failed = _failures([repo.name for repo in repos], results)
+    if failed:
+        raise InstallationError(f"Failed to add the {', '.join(failed)} repositories.")
 
     return True
 
 
-def install_fish_shell() -> bool:
-    """Installs Fish Shell.
+def add_repos() -> bool:
+    """Registers the keyring and source entry of every third-party repository."""
+
+    return asyncio.run(add_repos_async())
+
+
+def install_repo_pkgs() -> bool:
+    """Refreshes apt once and installs the packages of every third-party repository.
 
-    Installation instructions from <https://launchpad.net/~fish-shell/+archive/ubuntu/release-3>
+    Repositories only add their keyring and source entry in `add_repos`, so a single
+    `apt-get update` covers all of them instead of one full index refresh per repository.
     """
 
-    cmd = "apt-add-repository ppa:fish-shell/release-3 -y"
-    print("Adding Fish shell's apt repository...")
-    _, errs = comm(cmd)
-    if errs:
-        print(errs)
-        raise InstallationError("Failed to add Fish's ppa.")
-    print("Succesfully added.")
-
-    cmd = "apt update -y && apt install -y fish"
-    print("Installing fish...")
-    _, errs_ = comm(cmd)
-    if errs_:
-        errs = car_apt_warning(errs_)
-        if errs:
-            print(errs)
-            raise InstallationError("Failed to install Fish shell.")
+    apt_update()
+
+    print("Installing third-party apt packages...")
+    install_apt_batch(list_repo_pkgs())
     print("Installation successful.")
 
     return True
 
 
-def install_google_chrome() -> bool:
-    """Installs Google Chrome."""
+def invoking_user() -> str:
+    """Returns the user the machine is set up for, the one who ran sudo when running as root."""
 
-    file_name = "google-chrome-stable_current_amd64.deb"
-    file_url = f"https://dl.google.com/linux/direct/{file_name}"
-    cmd = f"cd {DOWNLOADS_PATH} && curl -sO {file_url}"
+    return os.environ.get("SUDO_USER") or os.environ.get("USER", "")
 
-    print("Downloading Google Chrome's .deb file...")
-    _, errs = comm(cmd)
-    if errs:
-        print(errs)
-        raise InstallationError("Failed to download Google Chrome's .deb file.")
-    print("Download successful.")
 
-    cmd = f"cd {DOWNLOADS_PATH} && apt install -y ./{file_name}"
-    print("Installing Google Chrome from .deb file...")
-    _, errs_ = comm(cmd)
-    if errs_:
-        errs = car_apt_warning(errs_)
-        if errs:
-            print(errs)
-            raise InstallationError("Failed to install Google Chrome from .deb file.")
-    print("Installation successful.")
+def invoking_home() -> Path:
+    """Returns the home directory of `invoking_user`.
+
+    Running as root under sudo that is the home of the user who ran sudo, not `/root`, so
+    user files planned or set up with sudo land where that user looks for them.
+    """
+
+    user = os.environ.get("SUDO_USER", "")
+    if os.geteuid() == 0 and user not in ("", "root"):
+        try:
+            return Path(pwd.getpwnam(user).pw_dir)
+        except KeyError:
+            pass
+    return Path.home()
+
+
+def user_in_groups() -> bool:
+    """Checks if the invoking user already belongs to every group of the manifest."""
+
+    user = invoking_user()
+    try:
+        return all(user in grp.getgrnam(group).gr_mem for group in current_manifest().groups())
+    except KeyError:
+        return False
 
-    return True
 
+def usermod_argv(group: str) -> List[str]:
+    """Returns the command adding the invoking user to `group`."""
 
-def install_poetry() -> bool:
-    """Installs Poetry (package manager for Python).
+    return ["usermod", "-aG", group, invoking_user()]
 
-    Installation instructions from <https://python-poetry.org/docs/>.
+
+def add_user_to_group(group: str) -> bool:
+    """Adds the invoking user to `group`.
+
+    Needed e.g. by docker, <https://docs.docker.com/engine/install/linux-postinstall/>.
     """
 
-    python_v = ""
-    if which("python3"):
-        python_v = "3"
-    cmd = f"curl -sSL https://raw.githubusercontent.com/python-poetry/poetry/master/get-poetry.py | python{python_v} -"
-    print("Executing Poetry's installation script...")
-    _, errs = comm(cmd)
-    if errs:
-        print(errs)
-        InstallationError("Poetry was not installed.")
-    print("Execution successful.")
+    print(f"Adding user to {group} group...")
+    result = run(usermod_argv(group))
+    if not result.ok:
+        print(result.stderr.decode(errors="replace"))
+        raise InstallationError(f"Failed to add user to {group} group.")
+    print(f"Successfully added user to {group} group")
 
     return True
 
 
-def install_qbittorrent() -> bool:
-    """Installs qbittorrent.
-    
-    Installation instructions from <https://www.qbittorrent.org/download.php>.
-    """
+def add_user_to_groups() -> bool:
+    """Adds the current user to every group of the manifest."""
 
-    cmd = "add-apt-repository ppa:qbittorrent-team/qbittorrent-stable -y"
-    print("Adding qbittorent's apt repository...")
-    _, errs = comm(cmd)
-    if errs:
-        print(errs)
-        raise InstallationError("Failed to add qbittorrent ppa.")
-    print("Successfully added.")
-
-    cmd = "apt update -y && apt install qbittorrent -y"
-    print("Installing qbittorrent...")
-    _, errs_ = comm(cmd)
-    if errs_:
-        errs = car_apt_warning(errs_)
-        if errs:
-            print(errs)
-            raise InstallationError("Failed to install qbittorrent.")
-    print("Installation successful.")
+    for group in current_manifest().groups():
+        add_user_to_group(group)
 
     return True
 
-    
-def install_not_ppkd_prog() -> bool:
-    """Installs all programs not in apt nor snap packages."""
 
-    # brave browser
-    print("Installing Brave Browser...")
-    try:
-        install_brave_browser()
-    except (InstallationError, TimeoutExpired):
-        raise InstallationError("Brave browser was not installed")
-    else:
-        print("Successfully installed Brave Browser.")
-
-    # docker
-    print("Installing Docker...")
-    try:
-        install_docker()
-    except (InstallationError, TimeoutExpired):
-        raise InstallationError("Docker was not installed.")
-    else:
-        print("Successfully installed Docker.")
+def deb_path(deb: Deb) -> str:
+    """Returns where the .deb file of `deb` is downloaded to."""
 
+    return f"{DOWNLOADS_PATH}/{os.path.basename(deb.url)}"
 
-    # fish shell
-    print("Installing Fish shell...")
-    try:
-        install_fish_shell()
-    except (InstallationError, TimeoutExpired):
-        raise InstallationError("Fish shell was not installed.")
-    print("Successfully installed Fish shell.")
 
-    # google chrome
-    print("Installing Google Chrome...")
-    try:
-        install_google_chrome()
-    except (InstallationError, TimeoutExpired):
-        raise InstallationError("Google Chrome was not installed.")
-    print("Successfully installed Google Chrome.")
+def deb_installed(deb: Deb) -> bool:
+    """Checks if the package of a .deb file is already installed."""
 
-    # poetry
-    print("Installing Poetry...")
-    try:
-        install_poetry()
-    except (InstallationError, TimeoutExpired):
-        raise InstallationError("Poetry was not installed.")
-    print("Successfully installed Poetry.")
+    return not missing_apt_pkgs([deb.package])
+
+
+def download_deb(deb: Deb) -> bool:
+    """Downloads a .deb file to `DOWNLOADS_PATH`."""
 
-    # qbittorrent
-    print("Installing qbittorrent...")
+    print(f"Downloading {deb.name}'s .deb file...")
     try:
-        install_poetry()
-    except (InstallationError, TimeoutExpired):
-        raise InstallationError("qbittorrent was not installed.")
-    print("Successfully installed qbittorrent.")
+        fetch_mirrors([deb.url, *deb.mirrors], lambda url: default_cache().copy_to(
+            url, deb_path(deb), sha256=deb.sha256 or None, progress=progress_printer(deb.name)))
+    except DownloadError as exc:
+        print(exc)
+        raise InstallationError(f"Failed to download {deb.name}'s .deb file.")
+    print("Download successful.")
+
+    return True
 
 
+def deb_install_argv(deb: Deb) -> List[str]:
+    """Returns the command installing the downloaded .deb of `deb`, run from `DOWNLOADS_PATH`."""
+
+    return ["apt-get", "install", "-y", *proxy_options(), f"./{os.path.basename(deb_path(deb))}"]
+
+
+def install_deb(deb: Deb) -> bool:
+    """Installs a .deb file fetched by `download_deb`."""
+
+    print(f"Installing {deb.name} from .deb file...")
+    result = run(deb_install_argv(deb), cwd=DOWNLOADS_PATH)
+    if not result.ok:
+        print(result.stderr.decode(errors="replace"))
+        raise InstallationError(f"Failed to install {deb.name} from .deb file.")
+    package_index().refresh_apt()
+    print("Installation successful.")
+
+    return True
+
+
+def script_ran(script: Script) -> bool:
+    """Checks if an installation script already ran."""
+
+    return bool(which(script.name)) or bool(script.creates and os.path.exists(os.path.expanduser(script.creates)))
+
+
+def run_script(script: Script) -> bool:
+    """Fetches an installation script and runs it, e.g. Poetry's <https://python-poetry.org/docs/>."""
+
+    interpreter = script.interpreter
+    if interpreter == "python3" and not which("python3"):
+        interpreter = "python"
+    try:
+        script_path = fetch_mirrors([script.url, *script.mirrors],
+                                    lambda url: default_cache().fetch(url, sha256=script.sha256 or None))
+    except DownloadError:
+        raise InstallationError(f"Failed to download {script.name}'s installation script.")
+
+    print(f"Executing {script.name}'s installation script...")
+    result = run([interpreter, script_path])
+    if not result.ok:
+        print(result.stderr.decode(errors="replace"))
+        raise InstallationError(f"{script.name}'s installation script exited with code {result.returncode}.")
+    print("Execution successful.")
+
     return True
 
 
+def installation_tasks(manifest: Optional[Manifest] = None) -> List[Task]:
+    """Compiles a manifest (the current one by default) into the installation graph.
+
+    Every installer declares the steps it needs (e.g. a repository's packages need the
+    repository registered) and whether it takes the dpkg lock, anything else
+    is free to run alongside. Probes let a converged host skip the steps already done.
+    """
+
+    manifest = manifest or current_manifest()
+
+    tasks = [
+        Task("pre_install", pre_install, inputs=DOWNLOADS_PATH),
+        Task("apt_pkgs", install_apt_pkgs, locks=[DPKG_LOCK], probe=apt_pkgs_installed,
+             inputs=manifest.apt),
+        Task("snap_pkgs", install_snap_pkgs, probe=snap_pkgs_installed,
+             inputs=[snap.spec() for snap in manifest.snaps]),
+
+        # every third-party repository is registered first, then refreshed and installed at once
+        Task("repos", add_repos, probe=repos_added, inputs=manifest.repos),
+        Task("repo_pkgs", install_repo_pkgs, deps=["repos"], locks=[DPKG_LOCK], probe=repo_pkgs_installed,
+             inputs=manifest.repo_pkgs()),
+        Task("groups", add_user_to_groups, deps=["repo_pkgs"], probe=user_in_groups, inputs=manifest.groups()),
+    ]
+
+    for deb in manifest.debs:
+        tasks += [
+            Task(f"{deb.name}_download", partial(download_deb, deb), deps=["pre_install"],
+                 probe=partial(deb_installed, deb), inputs=deb),
+            Task(deb.name, partial(install_deb, deb), deps=[f"{deb.name}_download"], locks=[DPKG_LOCK],
+                 probe=partial(deb_installed, deb), inputs=deb),
+        ]
+
+    for script in manifest.scripts:
+        tasks.append(Task(script.name, partial(run_script, script), probe=partial(script_ran, script),
+                          inputs=script))
+
+    return tasks
+
+
 def cleanup() -> bool:
     """Removes Downloads directory and apt cleans and apt autocleans the system."""
 
-    cmd = f"rm -r {DOWNLOADS_PATH}"
-    _, errs = comm(cmd)
-    if errs:
+    try:
+        rmtree(DOWNLOADS_PATH)
+    except OSError:
         return False
 
-    cmd = "apt autoclean && apt clean"
-    _, errs_ = comm(cmd)
-    if errs_:
-        errs = car_apt_warning(errs_)
-        if errs:
-            return False
-
-    return True
+    return run(["apt-get", "autoclean"]).ok and run(["apt-get", "clean"]).ok
 
 
 # testing installation commands
@@ -412,5 +484,5 @@ def cleanup() -> bool:
 #    pre_install()
 #    install_apt_pkgs()
 #    install_snap_pkgs()
-#    install_not_ppkd_prog()
+#    run_graph(installation_tasks())
 #    cleanup()
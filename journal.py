@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+
+JOURNAL_PATH = f"{Path.cwd()}/apollo_journal.jsonl"
+
+
+def inputs_hash(inputs: object) -> str:
+    """Returns a stable digest of a step's inputs (package lists, urls...)."""
+
+    data = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class Journal:
+    """Append-only record of the steps completed by previous runs.
+
+    Each line is a JSON object with the step name and the hash of its inputs, written and
+    synced as soon as the step succeeds, so an interrupted run can resume where it stopped.
+    A step is only considered done while its inputs stay the same.
+    """
+
+    def __init__(self, path: str = JOURNAL_PATH) -> None:
+        self.path = path
+        self._done: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf8") as file:
+                lines = file.readlines()
+        except OSError:
+            return
+
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a run killed in the middle of a write leaves a truncated last line
+                continue
+            self._done[record["step"]] = record["inputs"]
+
+    def is_done(self, step: str, digest: str) -> bool:
+        """Checks if `step` already completed with the same inputs."""
+
+        with self._lock:
+            return self._done.get(step) == digest
+
+    def record(self, step: str, digest: str) -> None:
+        """Appends the completion of `step` to the journal."""
+
+        line = json.dumps({"step": step, "inputs": digest, "time": time.time()})
+        with self._lock:
+            with open(self.path, "a", encoding="utf8") as file:
+                file.write(f"{line}\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self._done[step] = digest
+
+    def clear(self) -> None:
+        """Forgets every completed step, used once a whole run succeeded."""
+
+        with self._lock:
+            self._done.clear()
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def open_journal(path: Optional[str] = None) -> Journal:
+    """Returns the journal at `path`, or at `JOURNAL_PATH` by default."""
+
+    return Journal(path or JOURNAL_PATH)
@@ -0,0 +1,135 @@
+import base64
+import binascii
+import hashlib
+import re
+from typing import Iterator, List, Tuple
+from exceptions import KeyringError
+from fsutil import write_if_changed
+
+
+CRC24_INIT = 0xB704CE
+CRC24_POLY = 0x1864CFB
+PUBLIC_KEY_TAG = 6
+
+ARMOR_PATTERN = re.compile(rb"-----BEGIN PGP PUBLIC KEY BLOCK-----(.*?)-----END PGP PUBLIC KEY BLOCK-----",
+                           re.DOTALL)
+# prefix and size of the length hashed in front of a key packet, per key version
+FINGERPRINT_PREFIXES = {4: (b"\x99", 2), 5: (b"\x9a", 4), 6: (b"\x9b", 4)}
+
+
+def _crc24_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= CRC24_POLY
+        table.append(crc)
+    return table
+
+
+CRC24_TABLE = _crc24_table()
+
+
+def crc24(data: bytes) -> int:
+    """Returns the CRC-24 of `data`, the checksum of ASCII armor (RFC 4880, section 6.1)."""
+
+    crc = CRC24_INIT
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFF) ^ CRC24_TABLE[(crc >> 16) ^ byte]
+    return crc
+
+
+def _decode_block(block: bytes) -> bytes:
+    lines = [line.strip() for line in block.splitlines()]
+    # armor headers ("Version: ...", "Comment: ...") come before the first blank line
+    while lines and (not lines[0] or b":" in lines[0]):
+        lines.pop(0)
+    lines = [line for line in lines if line]
+
+    checksum = lines.pop()[1:] if lines and lines[-1].startswith(b"=") and len(lines[-1]) == 5 else None
+    try:
+        data = base64.b64decode(b"".join(lines), validate=True)
+        expected = int.from_bytes(base64.b64decode(checksum, validate=True), "big") if checksum else None
+    except binascii.Error as exc:
+        raise KeyringError(f"Invalid ASCII armor: {exc}")
+
+    # RFC 9580 made the checksum optional, it is verified whenever it is there
+    if expected is not None and crc24(data) != expected:
+        raise KeyringError(f"ASCII armor checksum mismatch: expected {expected:06X}, got {crc24(data):06X}.")
+    return data
+
+
+def dearmor(text: bytes) -> bytes:
+    """Decodes the ASCII armored public key blocks of `text` into a binary keyring, like `gpg --dearmor`."""
+
+    blocks = ARMOR_PATTERN.findall(text)
+    if not blocks:
+        raise KeyringError("No ASCII armored public key block found.")
+    return b"".join(_decode_block(block) for block in blocks)
+
+
+def _read(keyring: bytes, pos: int, size: int) -> bytes:
+    data = keyring[pos:pos + size]
+    if len(data) != size:
+        raise KeyringError(f"Truncated OpenPGP packet at offset {pos}.")
+    return data
+
+
+def packets(keyring: bytes) -> Iterator[Tuple[int, bytes]]:
+    """Yields the tag and body of every OpenPGP packet of a binary keyring (RFC 4880, section 4.2)."""
+
+    pos = 0
+    while pos < len(keyring):
+        header = keyring[pos]
+        if not header & 0x80:
+            raise KeyringError(f"No OpenPGP packet at offset {pos}.")
+
+        if header & 0x40:
+            tag = header & 0x3F
+            first = _read(keyring, pos + 1, 1)[0]
+            if first < 192:
+                length, pos = first, pos + 2
+            elif first < 224:
+                length, pos = ((first - 192) << 8) + _read(keyring, pos + 2, 1)[0] + 192, pos + 3
+            elif first == 255:
+                length, pos = int.from_bytes(_read(keyring, pos + 2, 4), "big"), pos + 6
+            else:
+                raise KeyringError(f"Partial body length in a key packet at offset {pos}.")
+        else:
+            tag = (header >> 2) & 0x0F
+            size = {0: 1, 1: 2, 2: 4}.get(header & 0x03)
+            if size is None:
+                raise KeyringError(f"Indeterminate length in a key packet at offset {pos}.")
+            length, pos = int.from_bytes(_read(keyring, pos + 1, size), "big"), pos + 1 + size
+
+        yield tag, _read(keyring, pos, length)
+        pos += length
+
+
+def fingerprint(key: bytes) -> str:
+    """Returns the fingerprint of a public key packet body, in upper case hex."""
+
+    if not key or key[0] not in FINGERPRINT_PREFIXES:
+        raise KeyringError(f"Unsupported OpenPGP key version {key[0] if key else None}.")
+
+    prefix, size = FINGERPRINT_PREFIXES[key[0]]
+    material = prefix + len(key).to_bytes(size, "big") + key
+    digest = hashlib.sha1(material) if key[0] == 4 else hashlib.sha256(material)
+    return digest.hexdigest().upper()
+
+
+def fingerprints(keyring: bytes) -> List[str]:
+    """Returns the fingerprints of the primary keys of a binary keyring, which must hold at least one."""
+
+    found = [fingerprint(body) for tag, body in packets(keyring) if tag == PUBLIC_KEY_TAG]
+    if not found:
+        raise KeyringError("The keyring holds no public key.")
+    return found
+
+
+def write_keyring(keyring: bytes, path: str) -> bool:
+    """Writes a binary keyring readable by apt to `path`, returns whether the file changed."""
+
+    return write_if_changed(path, keyring, 0o644)
@@ -2,17 +2,31 @@
 # -*- coding: utf-8 -*-
 
 
+import argparse
+import glob
+import os
 import pathlib
-from exceptions import InstallationError, ImgDownloadError
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from apt import use_apt_proxy
+from cli import comm_live
+from exceptions import FleetError, InstallationError, ImgDownloadError, ManifestError
+from fetch import HttpPool, set_default_pool
+from fleet import FLEET_MAX_WORKERS, SshTransport, fleet_summary, load_inventory, run_fleet
 from imgs import download_all_imgs
-from installers import (
-    cleanup,
-    install_apt_pkgs,
-    install_not_ppkd_prog,
-    install_snap_pkgs,
-    pre_install,
-)
+from installers import MANIFEST_PATH, cleanup, current_manifest, installation_tasks, invoking_user, use_manifest
+from journal import open_journal
+from plan import ROOT, USER, Plan, apply_plan, build_plan, print_plan
 from post_installers import post_install
+from profiling import enable_profiling
+from manifest import load_manifest
+from proxy import PROXY_BIND, ProxyServer, apt_hosts, installer_urls, start_proxy
+from scheduler import run_graph
+
+
+INSTALL_MAX_WORKERS = 4                                 # installation steps running at the same time
 
 
 def is_user_root() -> bool:
@@ -25,50 +39,31 @@ def is_user_root() -> bool:
     return False
 
 
-def main_installation() -> None:
-    """Installs all software to an Ubuntu machine."""
-
-    print("Installing packages... This might take a few minutes.")
-
-    print("Starting pre-installation procedures.")
-    try:
-        pre_install()
-    except InstallationError:
-        print("Pre-installation procedures failed.")
-        print("Exiting...")
-        return None
-
-    print("Pre-installation procedures were succesful.")
+def main_installation(max_workers: int = INSTALL_MAX_WORKERS) -> bool:
+    """Installs all software to an Ubuntu machine.
 
-    print("Continuing with software installation...")
-    try:
-        install_apt_pkgs()
-    except InstallationError:
-        print("There was a problem installing apt packages.")
-        print("Exiting...")
-        return None
+    Completed steps are journaled, so running the script again after a failure resumes
+    from the steps that did not complete.
+    """
 
-    try:
-        install_snap_pkgs()
-    except InstallationError:
-        print("There was a problem installing snap packages.")
-        print("Exiting...")
-        return None
+    print("Installing packages... This might take a few minutes.")
 
-    try:
-        install_not_ppkd_prog()
-    except InstallationError:
-        print("There was a problem installing other packages.")
+    journal = open_journal()
+    failures = run_graph(installation_tasks(), max_workers=max_workers, journal=journal)
+    if failures:
+        for name, exc in failures.items():
+            print(f"There was a problem with {name}: {exc}")
+        print("Run this script again to resume the installation.")
         print("Exiting...")
-        return None
+        return False
 
+    journal.clear()
     print("Installation successful.")
-    
-    print("Execute this script again as not root for post-installation procedures and cleanup")
+    return True
 
 
-def main_post_installation() -> None:
-    """Executes post-installation procedures."""
+def main_post_installation() -> bool:
+    """Executes post-installation procedures, returns `False` if they failed."""
 
     print("Starting post-installation procedures.")
     try:
@@ -76,7 +71,7 @@ def main_post_installation() -> None:
     except InstallationError:
         print("Post-installation procedures failed.")
         print("Exiting...")
-        return None
+        return False
     print("Post-installation procedures were successful.")
     
     print("Starting to download all images.")
@@ -85,6 +80,7 @@ def main_post_installation() -> None:
     except ImgDownloadError:
         print("Some images failed to download.")
         print("Continuing...")
+    return True
 
 
 def main_cleanup() -> None:
@@ -98,19 +94,185 @@ def main_cleanup() -> None:
         print("Cleanup successful.")
 
 
+def post_installation_cmd(user: str, proxy: str = "") -> List[str]:
+    """Returns the command running the post-installation as `user`, with the options it needs."""
+
+    # `-H` points HOME at the user's, `-u` keeps its output from arriving in one block at exit
+    cmd = ["sudo", "-u", user, "-H", sys.executable, "-u", os.path.abspath(__file__)]
+    return cmd + (["--proxy", proxy] if proxy else [])
+
 
-def main():
-    """Entry point for Apollo installer."""
+def main_all(user: str, proxy: str = "", max_workers: int = INSTALL_MAX_WORKERS) -> bool:
+    """Runs the installation and, as `user`, the post-installation at the same time.
 
-    if is_user_root():
-        main_installation()
+    The post-installation (config copies, TPM clone, image downloads) mostly waits on the
+    network, so it is hidden behind apt and snap. It runs in a `sudo -u` subprocess so its
+    files belong to `user`. Should it fail, e.g. because it needed a tool being installed,
+    it runs again once the installation is over.
+    """
+
+    cmd = post_installation_cmd(user, proxy)
+    print(f"Running the post-installation as {user} alongside the installation.")
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        post_installation = pool.submit(comm_live, cmd, "user")
+        installed = main_installation(max_workers)
+        code, _ = post_installation.result()
+
+    if code and installed:
+        print("Post-installation failed, running it again now that everything is installed.")
+        code, _ = comm_live(cmd, label="user")
+
+    if installed:
         main_cleanup()
+    return installed and code == 0
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parses the command line options."""
+
+    parser = argparse.ArgumentParser(description="Script to set up a newly installed ubuntu machine.")
+    parser.add_argument("--manifest", metavar="PATH",
+                        help=f"what to install, defaults to {MANIFEST_PATH}")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="time every step and command, and write a Chrome trace to PATH")
+    parser.add_argument("--plan", metavar="PATH", nargs="?", const="",
+                        help="print what would be done without doing it, and save the plan to PATH")
+    parser.add_argument("--apply", metavar="PATH", help="execute exactly the plan saved to PATH by --plan")
+    parser.add_argument("--fleet", metavar="INVENTORY",
+                        help="provision every host of INVENTORY over ssh instead of this machine")
+    parser.add_argument("--fleet-workers", metavar="N", type=int, default=FLEET_MAX_WORKERS,
+                        help=f"hosts provisioned at the same time, {FLEET_MAX_WORKERS} by default")
+    parser.add_argument("--proxy-serve", metavar="PORT", type=int,
+                        help="serve a caching package proxy on PORT for other hosts, until interrupted")
+    parser.add_argument("--proxy-bind", metavar="ADDR", default=PROXY_BIND,
+                        help=f"address the proxy listens on, {PROXY_BIND} by default, e.g. 0.0.0.0 for the LAN")
+    parser.add_argument("--proxy", metavar="URL",
+                        help="fetch packages and downloads through the apollo proxy at URL")
+    parser.add_argument("--all", action="store_true",
+                        help="with sudo, also run the post-installation as the invoking user at the same time")
+    return parser.parse_args(argv)
+
+
+def main_plan(path: str) -> None:
+    """Prints the plan for this host and saves it to `path`, if given."""
+
+    plan = build_plan()
+    print_plan(plan)
+    if path:
+        with open(path, "w", encoding="utf8") as file:
+            file.write(plan.to_json())
+        print(f"Plan saved to {path}, run it with --apply {path}.")
+
+
+def serve_proxy(port: int, bind: str) -> ProxyServer:
+    """Starts the caching proxy for the repositories and downloads of every manifest shipped with the installer.
+
+    The apt repositories this host uses are proxied as well, LAN clients usually share its mirrors.
+    """
+
+    manifests = [current_manifest()]
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(MANIFEST_PATH), "*.toml"))):
+        try:
+            manifests.append(load_manifest(path))
+        except ManifestError as exc:
+            print(f"Not proxying the downloads of {path}: {exc}")
+    return start_proxy(port, bind=bind, allowed_urls=installer_urls(manifests), apt_hosts=apt_hosts(manifests))
+
+
+def use_proxy(url: str) -> None:
+    """Sends every download of this run, apt's included, through the caching proxy at `url`."""
+
+    set_default_pool(HttpPool(proxy=url))
+    use_apt_proxy(url)
+
+
+def main_fleet(inventory: str, max_workers: int) -> bool:
+    """Provisions every host of an inventory and prints how each of them went."""
+
+    try:
+        hosts = load_inventory(inventory)
+    except FleetError as exc:
+        print(exc)
+        return False
+
+    print(f"Provisioning {len(hosts)} hosts, {max_workers} at a time.")
+    results = run_fleet(hosts, SshTransport(), max_workers=max_workers)
+    print(fleet_summary(results))
+    return all(result.ok for result in results)
+
+
+def main_apply(path: str) -> bool:
+    """Executes the ops of a saved plan belonging to the current user's phase."""
+
+    try:
+        with open(path, encoding="utf8") as file:
+            plan = Plan.from_json(file.read())
+    except (OSError, ValueError, TypeError, KeyError) as exc:
+        print(f"Could not read plan {path}: {exc}")
+        return False
+
+    phase = ROOT if is_user_root() else USER
+    print(f"Applying the {phase} steps of {path}.")
+    if not apply_plan(plan, phase):
+        print("Exiting...")
+        return False
+    print("Plan applied.")
+    return True
+
+
+def main(argv: Optional[List[str]] = None) -> bool:
+    """Entry point for Apollo installer, returns whether everything went well."""
+
+    args = parse_args(argv)
+    if args.manifest:
+        try:
+            use_manifest(args.manifest)
+        except ManifestError as exc:
+            print(exc)
+            return False
+    if args.all and not (is_user_root() and invoking_user() not in ("", "root")):
+        print("--all installs as root and sets up the user who ran sudo, run it with sudo as that user.")
+        return False
+    profiler = enable_profiling() if args.profile else None
+    server = serve_proxy(args.proxy_serve, args.proxy_bind) if args.proxy_serve else None
+    if args.proxy:
+        use_proxy(args.proxy)
+
+    if args.fleet:
+        ok = main_fleet(args.fleet, args.fleet_workers)
+    elif args.plan is not None:
+        main_plan(args.plan)
+        ok = True
+    elif args.apply:
+        ok = main_apply(args.apply)
+    elif args.all:
+        ok = main_all(invoking_user(), args.proxy or "")
+    elif is_user_root():
+        # keep the downloads of a failed run around for the next one to resume with
+        ok = main_installation()
+        if ok:
+            print("Run this script again as not root for post-installation procedures, or with --all next time.")
+            main_cleanup()
     else:
-        main_post_installation()
+        ok = main_post_installation()
+
+    if profiler is not None:
+        print("Run profile:")
+        print(profiler.report())
+        profiler.write_trace(args.profile)
+        print(f"Trace written to {args.profile}.")
+
+    if server is not None:
+        print("Still serving the proxy for other hosts, press Ctrl-C to stop.")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
 
     print("All done here.")
+    return ok
 
 
 if __name__ == "__main__":
 
-    main()
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,311 @@
+import json
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from exceptions import ManifestError
+
+try:
+    import tomllib                                      # python >= 3.11
+except ImportError:
+    tomllib = None
+
+
+@dataclass
+class Snap:
+    """A snap package and the flags passed to `snap install`."""
+
+    name: str
+    flags: List[str] = field(default_factory=list)
+
+    def spec(self) -> str:
+        """Returns the package as written after `snap install`."""
+
+        return " ".join([self.name, *self.flags])
+
+
+@dataclass
+class Repo:
+    """A third-party apt repository and the packages installed from it.
+
+    Either `ppa` or `uri` must be set. `suite` and `arch` may contain the `{codename}` and
+    `{arch}` placeholders, filled in with the host's values. A ppa's key is looked up on
+    Launchpad unless `fingerprint` pins it.
+    """
+
+    name: str
+    packages: List[str] = field(default_factory=list)
+    ppa: str = ""
+    key_url: str = ""
+    keyring: str = ""                                   # file name under /usr/share/keyrings, optional for ppas
+    dearmor: bool = False                               # the key is ASCII armored
+    fingerprint: str = ""                               # pins the key, checked against the downloaded one
+    uri: str = ""
+    suite: str = ""
+    components: List[str] = field(default_factory=list)
+    arch: str = "{arch}"
+    groups: List[str] = field(default_factory=list)     # groups the user is added to
+    key_mirrors: List[str] = field(default_factory=list)  # tried in order when `key_url` fails
+
+
+@dataclass
+class Deb:
+    """A .deb file installed straight from its url."""
+
+    name: str
+    url: str
+    package: str                                        # name of the package the .deb installs
+    mirrors: List[str] = field(default_factory=list)    # tried in order when `url` fails
+    sha256: str = ""                                    # expected digest of the download, checked if set
+
+
+@dataclass
+class Script:
+    """An installation script fetched from `url` and run with `interpreter`."""
+
+    name: str
+    url: str
+    interpreter: str = "python3"
+    creates: str = ""                                   # path existing once the script ran
+    mirrors: List[str] = field(default_factory=list)    # tried in order when `url` fails
+    sha256: str = ""                                    # expected digest of the download, checked if set
+
+
+@dataclass
+class Manifest:
+    """Everything a host role installs."""
+
+    apt: List[str] = field(default_factory=list)
+    snaps: List[Snap] = field(default_factory=list)
+    repos: List[Repo] = field(default_factory=list)
+    debs: List[Deb] = field(default_factory=list)
+    scripts: List[Script] = field(default_factory=list)
+
+    def merge(self, other: "Manifest") -> None:
+        """Adds the entries of `other`, later entries with the same name replace earlier ones."""
+
+        self.apt = dedup(self.apt + other.apt)
+        self.snaps = dedup_by_name(self.snaps + other.snaps)
+        self.repos = dedup_by_name(self.repos + other.repos)
+        self.debs = dedup_by_name(self.debs + other.debs)
+        self.scripts = dedup_by_name(self.scripts + other.scripts)
+
+    def repo_pkgs(self) -> List[str]:
+        """Returns the packages of every third-party repository."""
+
+        return dedup([pkg for repo in self.repos for pkg in repo.packages])
+
+    def groups(self) -> List[str]:
+        """Returns the groups the user has to be added to."""
+
+        return dedup([group for repo in self.repos for group in repo.groups])
+
+
+def dedup(items: List[str]) -> List[str]:
+    """Removes duplicates, keeping the first occurrence of each item."""
+
+    return list(dict.fromkeys(items))
+
+
+def dedup_by_name(entries: List[Any]) -> List[Any]:
+    """Removes entries sharing a name, keeping the position of the first and the value of the last."""
+
+    by_name: Dict[str, Any] = {}
+    for entry in entries:
+        by_name[entry.name] = entry
+    return [by_name[name] for name in dedup([entry.name for entry in entries])]
+
+
+def _build(cls: type, data: Dict[str, Any], path: str) -> Any:
+    try:
+        return cls(**data)
+    except TypeError as exc:
+        raise ManifestError(f"Invalid {cls.__name__.lower()} entry in {path}: {exc}")
+
+
+def _validate(manifest: Manifest, path: str) -> None:
+    for repo in manifest.repos:
+        if bool(repo.ppa) == bool(repo.uri):
+            raise ManifestError(f"Repository {repo.name} in {path} needs either a ppa or a uri.")
+        if repo.uri and not (repo.key_url and repo.keyring and repo.suite):
+            raise ManifestError(f"Repository {repo.name} in {path} needs key_url, keyring and suite.")
+
+
+def load_manifest(path: str, _seen: Optional[List[str]] = None) -> Manifest:
+    """Loads a manifest file and the manifests it includes.
+
+    Included files are relative to the including one and are merged before its own entries,
+    so a role file can extend a base manifest and override some of its entries.
+    """
+
+    path = os.path.abspath(path)
+    seen = _seen or []
+    if path in seen:
+        raise ManifestError(f"{path} includes itself.")
+
+    try:
+        with open(path, "rb") as file:
+            data = parse_toml(file.read().decode("utf8"))
+    except OSError as exc:
+        raise ManifestError(f"Could not read manifest {path}: {exc}")
+
+    manifest = Manifest()
+    for include in data.pop("include", []):
+        manifest.merge(load_manifest(os.path.join(os.path.dirname(path), include), seen + [path]))
+
+    own = Manifest(
+        apt=list(data.pop("apt", [])),
+        snaps=[_build(Snap, entry, path) for entry in data.pop("snap", [])],
+        repos=[_build(Repo, entry, path) for entry in data.pop("repo", [])],
+        debs=[_build(Deb, entry, path) for entry in data.pop("deb", [])],
+        scripts=[_build(Script, entry, path) for entry in data.pop("script", [])],
+    )
+    if data:
+        raise ManifestError(f"Unknown keys in {path}: {', '.join(sorted(data))}.")
+    _validate(own, path)
+    manifest.merge(own)
+
+    return manifest
+
+
+def parse_toml(text: str) -> Dict[str, Any]:
+    """Parses a TOML document, with `tomllib` when the interpreter ships it.
+
+    Older pythons (Ubuntu 20.04 comes with 3.8) fall back to a parser covering what
+    manifests use: comments, strings, booleans, integers, arrays, `[table]` and
+    `[[array of tables]]` headers.
+    """
+
+    if tomllib is not None:
+        try:
+            return tomllib.loads(text)
+        except tomllib.TOMLDecodeError as exc:
+            raise ManifestError(f"Invalid manifest: {exc}")
+    return _parse_toml_subset(text)
+
+
+_KEY = re.compile(r"\s*([A-Za-z0-9_-]+)\s*=\s*")
+_HEADER = re.compile(r"\s*(\[\[?)\s*([A-Za-z0-9_-]+)\s*(\]\]?)\s*$")
+
+
+def _parse_toml_subset(text: str) -> Dict[str, Any]:
+    doc: Dict[str, Any] = {}
+    table = doc
+    lines = text.splitlines()
+    i = 0
+
+    while i < len(lines):
+        line = _strip_comment(lines[i])
+        i += 1
+        if not line.strip():
+            continue
+
+        header = _HEADER.match(line)
+        if header:
+            opening, name, closing = header.groups()
+            if len(opening) != len(closing):
+                raise ManifestError(f"Invalid table header: {line.strip()}")
+            if opening == "[[":
+                table = {}
+                doc.setdefault(name, []).append(table)
+            else:
+                table = doc.setdefault(name, {})
+            continue
+
+        key = _KEY.match(line)
+        if not key:
+            raise ManifestError(f"Invalid manifest line: {line.strip()}")
+
+        # arrays may span several lines
+        value = line[key.end():]
+        while _depth(value) > 0 and i < len(lines):
+            value += " " + _strip_comment(lines[i])
+            i += 1
+
+        try:
+            parsed, rest = _parse_value(value.strip())
+        except (ValueError, IndexError):
+            raise ManifestError(f"Invalid value for {key.group(1)}: {value.strip()}")
+        if rest.strip():
+            raise ManifestError(f"Unexpected {rest.strip()} after value of {key.group(1)}.")
+        table[key.group(1)] = parsed
+
+    return doc
+
+
+def _unquoted(text: str) -> Iterator[Tuple[int, str]]:
+    """Yields the position and value of every character of `text` outside of strings.
+
+    Basic (`"`) strings honor backslash escapes, literal (`'`) ones do not.
+    """
+
+    quote = ""
+    escaped = False
+    for pos, char in enumerate(text):
+        if escaped:
+            escaped = False
+        elif quote:
+            if char == "\\" and quote == '"':
+                escaped = True
+            elif char == quote:
+                quote = ""
+        elif char in "\"'":
+            quote = char
+        else:
+            yield pos, char
+
+
+def _strip_comment(line: str) -> str:
+    for pos, char in _unquoted(line):
+        if char == "#":
+            return line[:pos]
+    return line
+
+
+def _depth(text: str) -> int:
+    """Returns how many arrays are left open in `text`, ignoring brackets within strings."""
+
+    depth = 0
+    for _, char in _unquoted(text):
+        if char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+    return depth
+
+
+def _parse_value(text: str) -> Tuple[Any, str]:
+    """Parses the value at the start of `text` and returns it with the unparsed rest."""
+
+    if text.startswith('"'):
+        end = 1
+        while end < len(text) and text[end] != '"':
+            end += 2 if text[end] == "\\" else 1
+        # basic strings share their escapes with JSON
+        try:
+            return json.loads(text[:end + 1]), text[end + 1:]
+        except ValueError:
+            raise ManifestError(f"Invalid string: {text[:end + 1]}")
+    if text.startswith("'"):
+        end = text.index("'", 1)
+        return text[1:end], text[end + 1:]
+    if text.startswith("["):
+        items: List[Any] = []
+        rest = text[1:].lstrip()
+        while not rest.startswith("]"):
+            item, rest = _parse_value(rest)
+            items.append(item)
+            rest = rest.lstrip()
+            if rest.startswith(","):
+                rest = rest[1:].lstrip()
+            elif not rest.startswith("]"):
+                raise ManifestError(f"Expected , or ] in array, got {rest[:20]}")
+        return items, rest[1:]
+
+    match = re.match(r"(true|false|[+-]?\d+)", text)
+    if not match:
+        raise ManifestError(f"Unsupported manifest value: {text[:20]}")
+    word = match.group(1)
+    if word in ("true", "false"):
+        return word == "true", text[match.end():]
+    return int(word), text[match.end():]
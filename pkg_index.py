@@ -0,0 +1,133 @@
+import os
+import threading
+from typing import Dict, List, Optional
+from cli import run
+
+
+DPKG_STATUS_PATH = "/var/lib/dpkg/status"
+
+
+def parse_dpkg_status(status: str) -> Dict[str, str]:
+    """Maps the name of every installed package in a dpkg status file to its version."""
+
+    pkgs: Dict[str, str] = {}
+
+    for paragraph in status.split("\n\n"):
+        name = version = ""
+        is_installed = False
+        for line in paragraph.splitlines():
+            if line.startswith("Package: "):
+                name = line[len("Package: "):].strip()
+            elif line.startswith("Version: "):
+                version = line[len("Version: "):].strip()
+            elif line.startswith("Status: "):
+                is_installed = line.rstrip().endswith(" installed")
+        if name and is_installed:
+            pkgs[name] = version
+
+    return pkgs
+
+
+def parse_snap_list(output: str) -> Dict[str, str]:
+    """Maps the name of every snap in the output of `snap list` to its version."""
+
+    pkgs: Dict[str, str] = {}
+
+    # the first line is the table header
+    for row in output.splitlines()[1:]:
+        cols = row.split()
+        if len(cols) >= 2:
+            pkgs[cols[0]] = cols[1]
+
+    return pkgs
+
+
+class PackageIndex:
+    """In-process index of the installed apt and snap packages.
+
+    Each source is read once, on first use, so every lookup afterwards is a dict access
+    instead of a `dpkg -s` or `snap info` process. dpkg's status file is only parsed again
+    when it changed on disk, snaps installed during the run are recorded with `add_snap`.
+    """
+
+    def __init__(self, status_path: str = DPKG_STATUS_PATH) -> None:
+        self.status_path = status_path
+        self._apt: Optional[Dict[str, str]] = None
+        self._apt_stamp = (0, 0)
+        self._snaps: Optional[Dict[str, str]] = None
+        self._lock = threading.RLock()
+
+    def refresh_apt(self) -> None:
+        """Re-reads dpkg's status file, unless it did not change since the last read."""
+
+        with self._lock:
+            try:
+                stat = os.stat(self.status_path)
+                stamp = (stat.st_mtime_ns, stat.st_size)
+                if self._apt is not None and stamp == self._apt_stamp:
+                    return
+                with open(self.status_path, encoding="utf8", errors="replace") as file:
+                    self._apt = parse_dpkg_status(file.read())
+                self._apt_stamp = stamp
+            except OSError:
+                self._apt = {}
+
+    def refresh_snaps(self) -> None:
+        """Re-reads the installed snaps with a single `snap list` call."""
+
+        result = run(["snap", "list"])
+        snaps = parse_snap_list(result.stdout.decode(errors="replace")) if result.ok else {}
+        with self._lock:
+            self._snaps = snaps
+
+    def add_snap(self, name: str, version: str = "") -> None:
+        """Records a snap installed during this run without listing every snap again."""
+
+        with self._lock:
+            if self._snaps is None:
+                self.refresh_snaps()
+            self._snaps[name] = version
+
+    def apt_version(self, name: str) -> Optional[str]:
+        """Returns the installed version of an apt package, `None` if it is not installed."""
+
+        with self._lock:
+            if self._apt is None:
+                self.refresh_apt()
+            return self._apt.get(name)
+
+    def snap_version(self, name: str) -> Optional[str]:
+        """Returns the installed version of a snap, `None` if it is not installed."""
+
+        with self._lock:
+            if self._snaps is None:
+                self.refresh_snaps()
+            return self._snaps.get(name)
+
+    def missing_apt(self, pkgs: List[str]) -> List[str]:
+        """Returns the apt packages of `pkgs` that are not installed."""
+
+        # only a `stat` when nothing was installed since the last read
+        self.refresh_apt()
+        return [pkg for pkg in pkgs if self.apt_version(pkg) is None]
+
+    def missing_snaps(self, pkgs: List[str]) -> List[str]:
+        """Returns the snaps of `pkgs` that are not installed, entries may carry flags."""
+
+        return [pkg for pkg in pkgs if self.snap_version(pkg.split()[0]) is None]
+
+
+_INDEX = PackageIndex()
+
+
+def package_index() -> PackageIndex:
+    """Returns the index shared by the whole run."""
+
+    return _INDEX
+
+
+def set_package_index(index: PackageIndex) -> None:
+    """Replaces the index shared by the whole run, e.g. with one reading a fixture status file."""
+
+    global _INDEX
+    _INDEX = index
@@ -0,0 +1,264 @@
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from apt import apt_install_argv, apt_update, apt_update_argv, install_apt_batch
+from cache import cached_size, default_cache
+from cli import argv_text, run
+from exceptions import DownloadError, InstallationError
+from fetch import progress_printer
+from imgs import list_imgs
+import installers
+from installers import (
+    add_repo,
+    add_user_to_group,
+    current_manifest,
+    deb_install_argv,
+    deb_installed,
+    deb_path,
+    install_deb,
+    install_snap_pkg,
+    repo_added,
+    run_script,
+    script_ran,
+    snap_install_argv,
+    user_in_groups,
+    usermod_argv,
+)
+from manifest import Deb, Manifest, Repo, Script
+from pkg_index import package_index
+from retry import fetch_mirrors
+from sources import keyring_path, sources_path
+from post_installers import TPM_REPO, clone_argv, config_files, copy_config, files_match, sync_repo, tpm_path
+
+
+ROOT = "root"                                           # ops run by the installation phase
+USER = "user"                                           # ops run by the post-installation phase
+PLAN_VERSION = 1
+
+
+@dataclass
+class Op:
+    """A single operation of a plan, `args` hold everything needed to execute it."""
+
+    kind: str
+    phase: str
+    cmd: str                                            # what gets run, for display
+    args: Dict[str, Any] = field(default_factory=dict)
+    size: Optional[int] = None                          # bytes downloaded, `None` if unknown
+
+
+@dataclass
+class Plan:
+    """The operations needed to bring the host to the state described by a manifest."""
+
+    ops: List[Op] = field(default_factory=list)
+
+    def download_size(self) -> Tuple[int, int]:
+        """Returns the bytes downloaded by the ops of known size and how many ops have an unknown size."""
+
+        downloads = [op for op in self.ops if op.kind in DOWNLOAD_KINDS]
+        known = sum(op.size for op in downloads if op.size is not None)
+        return known, sum(1 for op in downloads if op.size is None)
+
+    def to_json(self) -> str:
+        """Serializes the plan, to be executed later by `apply_plan`."""
+
+        return json.dumps({"version": PLAN_VERSION, "ops": [asdict(op) for op in self.ops]}, indent=2)
+
+    @classmethod
+    def from_json(cls, text: str) -> "Plan":
+        """Reads a plan serialized by `to_json`, raising `ValueError` on ops `apply_plan` can not run."""
+
+        data = json.loads(text)
+        if data.get("version") != PLAN_VERSION:
+            raise ValueError(f"Unsupported plan version {data.get('version')}.")
+
+        ops = [Op(**op) for op in data["ops"]]
+        for op in ops:
+            # a hand edited plan, or one from another version, is refused before anything runs
+            if op.kind not in EXECUTORS:
+                raise ValueError(f"Unknown op kind {op.kind!r}.")
+            if op.phase not in (ROOT, USER):
+                raise ValueError(f"Unknown phase {op.phase!r} for {op.cmd}.")
+        return cls(ops)
+
+
+# ops that download something, apt, snap and script sizes are only known for some of them
+DOWNLOAD_KINDS = {"apt_install", "snap_install", "download", "script"}
+
+
+def apt_download_sizes(pkgs: List[str]) -> Dict[str, int]:
+    """Returns the size of the .deb of every package apt knows about, with a single `apt-cache` call.
+
+    Dependencies pulled in by the packages are not included.
+    """
+
+    if not pkgs:
+        return {}
+
+    # exits with an error when some package is unknown, the others are still listed
+    outs = run(["apt-cache", "show", "--no-all-versions", *pkgs]).stdout
+    sizes: Dict[str, int] = {}
+    for paragraph in outs.decode(errors="replace").split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in paragraph.splitlines() if ": " in line)
+        if "Package" in fields and fields.get("Size", "").isdigit():
+            sizes[fields["Package"]] = int(fields["Size"])
+    return sizes
+
+
+def _apt_op(pkgs: List[str], sizes: Dict[str, int]) -> Op:
+    size = sum(sizes[pkg] for pkg in pkgs) if all(pkg in sizes for pkg in pkgs) else None
+    return Op("apt_install", ROOT, argv_text(apt_install_argv(pkgs)), {"pkgs": pkgs}, size)
+
+
+def _repo_cmd(repo: Repo) -> str:
+    return f"add {keyring_path(repo)} and {sources_path(repo)}"
+
+
+def plan_installation(manifest: Manifest) -> List[Op]:
+    """Returns the installation ops that are not satisfied on this host yet."""
+
+    index = package_index()
+    ops: List[Op] = []
+
+    missing_repos = [repo for repo in manifest.repos if not repo_added(repo)]
+    missing_apt = index.missing_apt(manifest.apt)
+    missing_repo_pkgs = index.missing_apt(manifest.repo_pkgs())
+    sizes = apt_download_sizes(missing_apt + missing_repo_pkgs)
+
+    downloads = installers.DOWNLOADS_PATH
+    if not os.path.isdir(downloads):
+        ops.append(Op("mkdir", ROOT, f"mkdir -p {downloads}", {"path": downloads}))
+    if missing_apt:
+        ops.append(_apt_op(missing_apt, sizes))
+
+    for spec in index.missing_snaps([snap.spec() for snap in manifest.snaps]):
+        ops.append(Op("snap_install", ROOT, argv_text(snap_install_argv(spec)), {"spec": spec}))
+
+    for repo in missing_repos:
+        ops.append(Op("repo_add", ROOT, _repo_cmd(repo), {"repo": asdict(repo)}))
+    if missing_repos or missing_repo_pkgs:
+        ops.append(Op("apt_update", ROOT, argv_text(apt_update_argv())))
+    if missing_repo_pkgs:
+        ops.append(_apt_op(missing_repo_pkgs, sizes))
+
+    if not user_in_groups():
+        for group in manifest.groups():
+            ops.append(Op("group_add", ROOT, argv_text(usermod_argv(group)), {"group": group}))
+
+    for deb in manifest.debs:
+        if deb_installed(deb):
+            continue
+        args = {"url": deb.url, "mirrors": deb.mirrors, "dest": deb_path(deb), "sha256": deb.sha256}
+        ops.append(Op("download", ROOT, f"download {deb.url} to {deb_path(deb)}", args, cached_size(deb.url)))
+        # displayed as run, from the downloads directory
+        cmd = f"cd {installers.DOWNLOADS_PATH} && {argv_text(deb_install_argv(deb))}"
+        ops.append(Op("deb_install", ROOT, cmd, {"deb": asdict(deb)}))
+
+    for script in manifest.scripts:
+        if not script_ran(script):
+            ops.append(Op("script", ROOT, f"{script.interpreter} <{script.url}>", {"script": asdict(script)},
+                          cached_size(script.url)))
+
+    return ops
+
+
+def plan_post_installation() -> List[Op]:
+    """Returns the post-installation ops that are not satisfied on this host yet."""
+
+    ops: List[Op] = []
+
+    for files in config_files().values():
+        for src, dest in files:
+            if not files_match(src, dest):
+                ops.append(Op("copy", USER, f"cp {src} {dest}", {"src": src, "dest": dest}))
+
+    if not os.path.isdir(f"{tpm_path()}/.git"):
+        ops.append(Op("git_clone", USER, argv_text(clone_argv(TPM_REPO, tpm_path())),
+                      {"url": TPM_REPO, "dest": tpm_path()}))
+
+    for url, dest in list_imgs():
+        if not os.path.isfile(dest):
+            ops.append(Op("download", USER, f"download {url} to {dest}", {"url": url, "dest": dest},
+                          cached_size(url)))
+
+    return ops
+
+
+def build_plan(manifest: Optional[Manifest] = None) -> Plan:
+    """Computes the minimal set of ops for both phases, without changing anything on the host."""
+
+    return Plan(plan_installation(manifest or current_manifest()) + plan_post_installation())
+
+
+def format_size(size: int) -> str:
+    """Returns `size` bytes in a human readable unit."""
+
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def print_plan(plan: Plan) -> None:
+    """Prints the commands of a plan and its estimated download size."""
+
+    if not plan.ops:
+        print("Nothing to do, the host is up to date.")
+        return
+
+    for phase, title in ((ROOT, "As root:"), (USER, "As user:")):
+        ops = [op for op in plan.ops if op.phase == phase]
+        if ops:
+            print(title)
+        for op in ops:
+            size = f"  ({format_size(op.size)})" if op.size is not None else ""
+            print(f"  {op.cmd}{size}")
+
+    known, unknown = plan.download_size()
+    print(f"Estimated download: {format_size(known)}"
+          + (f" plus {unknown} downloads of unknown size." if unknown else "."))
+
+
+def _download(args: Dict[str, Any]) -> None:
+    dest = args["dest"]
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    progress = progress_printer(os.path.basename(dest))
+    try:
+        fetch_mirrors([args["url"], *args.get("mirrors", [])], lambda url: default_cache().copy_to(
+            url, dest, sha256=args.get("sha256") or None, progress=progress))
+    except DownloadError as exc:
+        raise InstallationError(str(exc))
+
+
+EXECUTORS: Dict[str, Callable[[Dict[str, Any]], object]] = {
+    "mkdir": lambda args: os.makedirs(args["path"], exist_ok=True),
+    "apt_install": lambda args: install_apt_batch(args["pkgs"]),
+    "snap_install": lambda args: install_snap_pkg(args["spec"]),
+    "repo_add": lambda args: add_repo(Repo(**args["repo"])),
+    "apt_update": lambda args: apt_update(),
+    "group_add": lambda args: add_user_to_group(args["group"]),
+    "download": _download,
+    "deb_install": lambda args: install_deb(Deb(**args["deb"])),
+    "script": lambda args: run_script(Script(**args["script"])),
+    "copy": lambda args: copy_config(args["src"], args["dest"]),
+    "git_clone": lambda args: sync_repo(args["url"], args["dest"]),
+}
+
+
+def apply_plan(plan: Plan, phase: str) -> bool:
+    """Executes the ops of `phase` exactly as planned, in order, stopping at the first failure."""
+
+    for op in plan.ops:
+        if op.phase != phase:
+            continue
+        print(f"Running {op.cmd}")
+        try:
+            EXECUTORS[op.kind](op.args)
+        except (InstallationError, OSError) as exc:
+            print(f"Failed: {exc}")
+            return False
+
+    return True
@@ -1,95 +1,166 @@
-from pathlib import Path
-from shutil import copyfile, SameFileError
-from cli import comm, car_expected_err_msg
-from exceptions import CliError, InstallationError
-from installers import CONFIG_FILES_PATH
+import os.path
+import stat
+import subprocess as subp
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from shutil import rmtree
+from typing import Dict, List, Tuple
+from cache import sha256_file
+from cli import run
+from exceptions import InstallationError
+from fsutil import write_if_changed
+from installers import CONFIG_FILES_PATH, invoking_home
+from profiling import profiled
+from retry import NETWORK_RETRY, retry_call
 
 
-HOME_PATH = Path.home()
+HOME_PATH = invoking_home()
+TPM_REPO = "https://github.com/tmux-plugins/tpm"
 
 
-def post_fish_shell() -> bool:
-    """Sets fish as the default shell and copies fish functions to their configuration directory."""
+def config_files() -> Dict[str, List[Tuple[str, str]]]:
+    """Returns the configuration files of every tool as `(source, destination)` pairs."""
 
-    config_dest = f"{HOME_PATH}/.config/fish/functions"
+    fish_functions = ["fish_greeting.fish", "fish_prompt.fish"]
 
-    cmd = f"mkdir -p {config_dest}"
-    _, errs = comm(cmd)
-    if errs:
-        raise CliError(f"Failed to create {config_dest} directory.")
+    return {
+        "fish": [(f"{CONFIG_FILES_PATH}/fish/{file}", f"{HOME_PATH}/.config/fish/functions/{file}")
+                 for file in fish_functions],
+        "neovim": [(f"{CONFIG_FILES_PATH}/neovim/init.vim", f"{HOME_PATH}/.config/neovim/init.vim")],
+        "tmux": [(f"{CONFIG_FILES_PATH}/tmux/tmux.conf", f"{HOME_PATH}/.tmux.conf")],
+    }
 
-    files = ["fish_greeting.fish", "fish_prompt.fish"]
-    for file in files:
-        src = f"{CONFIG_FILES_PATH}/fish/{file}"
-        try:
-            copyfile(src, f"{config_dest}/{file}")
-        except SameFileError:
-            raise SameFileError("The source and destination files are the same.") from SameFileError
 
-    return True
+def tpm_path() -> str:
+    """Returns where Tmux Plugin Manager is cloned to."""
 
+    return f"{HOME_PATH}/.tmux/plugins/tpm"
+
+
+def files_match(src: str, dest: str) -> bool:
+    """Checks if `dest` already holds the same content as `src`."""
+
+    if not os.path.isfile(dest):
+        return False
+    return sha256_file(src) == sha256_file(dest)
 
-def post_neovim() -> None:
-    """Copies neovim's config file to its repective directory."""
 
-    dst = f"{HOME_PATH}/.config/neovim"
-    cmd = f"mkdir -p {dst}"
-    _, errs = comm(cmd)
-    if errs:
-        raise CliError(f"Failed to create {cmd} directory.")
+def copy_config(src: str, dest: str) -> bool:
+    """Copies `src` to `dest` unless `dest` is already up to date, returns whether it copied.
+
+    Missing directories are created and the file is written to a temporary file renamed
+    over `dest`, so a config is never seen half written.
+    """
 
-    src = f"{CONFIG_FILES_PATH}/neovim/init.vim"
     try:
-        copyfile(src, f"{dst}/init.vim")
-    except SameFileError:
-        raise SameFileError("The source and destination files are the same.") from SameFileError
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(src, "rb") as file:
+            return write_if_changed(dest, file.read(), stat.S_IMODE(os.fstat(file.fileno()).st_mode))
+    except OSError as exc:
+        raise InstallationError(f"Failed to copy {src} to {dest}: {exc}")
 
 
-def post_tmux() -> bool:
-    """Fetches Tmux Plugin Manager and copies `.tmux.conf` file to `HOME_PATH`."""
+def sync_configs(tool: str) -> int:
+    """Copies the configuration files of `tool` that changed, returns how many were copied."""
+
+    return sum(copy_config(src, dest) for src, dest in config_files()[tool])
+
+
+def clone_argv(url: str, dest: str) -> List[str]:
+    """Returns the command shallow cloning `url` to `dest`."""
+
+    return ["git", "clone", "--depth", "1", "-q", url, dest]
+
+
+def clone_repo(url: str, dest: str) -> None:
+    """Shallow clones `url` to `dest`, retrying flaky networks."""
+
+    attempts = []
+
+    def attempt() -> None:
+        if attempts:
+            # an attempt killed on timeout leaves a partial clone git refuses to clone over
+            rmtree(dest, ignore_errors=True)
+        attempts.append(dest)
+        if not run(clone_argv(url, dest), timeout=NETWORK_RETRY.timeout).ok:
+            raise InstallationError(f"git clone {url} failed")
 
-    tpm_repo = "https://github.com/tmux-plugins/tpm"        # tpm repo url
-    tpm_clone_path = f"{HOME_PATH}/.tmux/plugins/tpm"       # tpm repo dest path
-
-    # clone Tmux Plugin Manager github repo
-    cmd = f"git clone {tpm_repo} {tpm_clone_path}"
-    _, errs_ = comm(cmd)
-    if errs_:
-        expected_err_msg = bytes(f"Cloning into '{HOME_PATH}/.tmux/plugins/tpm'...\n", "utf8")
-        errs = car_expected_err_msg(expected_err_msg, errs_)
-        if errs:
-            raise InstallationError("Failed to clone Tmux Plugin Manager's github repo.")
-
-    # copy .tmux.conf file
-    src = f"{CONFIG_FILES_PATH}/tmux/tmux.conf"             # tmux.conf source path
-    dest = f"{HOME_PATH}/.tmux.conf"                        # tmux.conf dest path
     try:
-        copyfile(src, dest)
-    except SameFileError:
-        raise SameFileError("The source and destination files are the same.") from SameFileError
+        retry_call(attempt, f"Cloning {url}")
+    except (InstallationError, subp.TimeoutExpired):
+        raise InstallationError(f"Failed to clone {url}.")
 
+
+def sync_repo(url: str, dest: str) -> bool:
+    """Shallow clones `url` to `dest`, or moves an existing clone to the latest upstream commit."""
+
+    if not os.path.isdir(f"{dest}/.git"):
+        clone_repo(url, dest)
+        return True
+
+    # a shallow clone can not be fast-forwarded once upstream moved, it is reset to the fetched commit instead
+    try:
+        updated = (run(["git", "-C", dest, "fetch", "-q", "--depth", "1", "origin", "HEAD"],
+                       timeout=NETWORK_RETRY.timeout).ok
+                   and run(["git", "-C", dest, "reset", "-q", "--hard", "FETCH_HEAD"]).ok)
+    except subp.TimeoutExpired:
+        updated = False
+    if not updated:
+        # the existing clone still works, it is only out of date
+        print(f"Could not update {dest}, keeping the current version.")
     return True
 
 
+@profiled
+def post_fish_shell() -> bool:
+    """Copies fish functions to their configuration directory."""
+
+    sync_configs("fish")
+    return True
+
+
+@profiled
+def post_neovim() -> bool:
+    """Copies neovim's config file to its repective directory."""
+
+    sync_configs("neovim")
+    return True
+
+
+@profiled
+def post_tmux() -> bool:
+    """Fetches Tmux Plugin Manager and copies `.tmux.conf` file to `HOME_PATH`."""
+
+    sync_repo(TPM_REPO, tpm_path())
+    sync_configs("tmux")
+    return True
+
+
+POST_INSTALLERS = {
+    "Fish shell": post_fish_shell,
+    "Neovim": post_neovim,
+    "Tmux": post_tmux,
+}
+
+
 def post_install() -> bool:
-    """Procedures that should occur after all programs have been installed."""
+    """Procedures that should occur after all programs have been installed.
 
-    print("Starting post-installation procedures for Fish shell.")
-    try:
-        post_fish_shell()
-    except InstallationError:
-        raise InstallationError("Fish shell's post installation procedures failed.")
+    Tools are set up concurrently, they touch different files and only tmux needs the network.
+    """
 
-    print("Starting post-installation procedures for Neovim.")
-    try:
-        post_neovim()
-    except InstallationError:
-        raise InstallationError("Neovim's post installation procedures failed.")
+    failed: List[str] = []
 
-    print("Starting post-installation procedures for Tmux.")
-    try:
-        post_tmux()
-    except InstallationError:
-        raise InstallationError("Tmux's post installation procedures failed.")
+    print("Starting post-installation procedures for " + ", ".join(POST_INSTALLERS) + ".")
+    with ThreadPoolExecutor(max_workers=len(POST_INSTALLERS)) as pool:
+        futures = {pool.submit(func): tool for tool, func in POST_INSTALLERS.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except InstallationError as exc:
+                print(exc)
+                failed.append(futures[future])
+
+    if failed:
+        raise InstallationError(f"{', '.join(sorted(failed))}'s post installation procedures failed.")
 
     return True
@@ -0,0 +1,131 @@
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Callable, Iterator, List, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+
+@dataclass
+class Span:
+    """Timing of a single command or installation step."""
+
+    name: str
+    kind: str                                           # "cmd" or "step"
+    start: float                                        # seconds since the profiler started
+    wall: float = 0.0
+    child_cpu: float = 0.0                              # user + system time of finished children
+    out_bytes: int = 0
+    exit_code: Optional[int] = None
+    thread: int = 0
+
+
+def _children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Profiler:
+    """Records a `Span` for every command and step of a run.
+
+    Child CPU time comes from `RUSAGE_CHILDREN`, which is process wide: when steps run in
+    parallel the CPU time of overlapping spans is attributed to whichever ends first.
+    """
+
+    def __init__(self) -> None:
+        self.spans: List[Span] = []
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, kind: str) -> Iterator[Span]:
+        """Times the body of the `with` block, which can fill in `out_bytes` and `exit_code`."""
+
+        span = Span(name, kind, time.perf_counter() - self._t0, thread=threading.get_ident())
+        cpu = _children_cpu()
+        try:
+            yield span
+        finally:
+            span.wall = time.perf_counter() - self._t0 - span.start
+            span.child_cpu = _children_cpu() - cpu
+            with self._lock:
+                self.spans.append(span)
+
+    def report(self, limit: int = 20) -> str:
+        """Returns the slowest spans as a table."""
+
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.wall, reverse=True)[:limit]
+
+        lines = [f"{'wall (s)':>9} {'cpu (s)':>8} {'out (KiB)':>10} {'exit':>5}  {'kind':<5} name"]
+        for span in spans:
+            code = "" if span.exit_code is None else str(span.exit_code)
+            lines.append(f"{span.wall:>9.2f} {span.child_cpu:>8.2f} {span.out_bytes / 1024:>10.1f} "
+                         f"{code:>5}  {span.kind:<5} {span.name}")
+        return "\n".join(lines)
+
+    def write_trace(self, path: str) -> None:
+        """Writes every span as a Chrome trace (chrome://tracing, Perfetto) JSON file."""
+
+        with self._lock:
+            spans = list(self.spans)
+
+        events = [{
+            "name": span.name,
+            "cat": span.kind,
+            "ph": "X",
+            "ts": span.start * 1e6,
+            "dur": span.wall * 1e6,
+            "pid": os.getpid(),
+            "tid": span.thread,
+            "args": asdict(span),
+        } for span in spans]
+
+        with open(path, "w", encoding="utf8") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+
+_PROFILER: Optional[Profiler] = None
+
+
+def enable_profiling() -> Profiler:
+    """Starts recording spans for the rest of the run."""
+
+    global _PROFILER
+    _PROFILER = Profiler()
+    return _PROFILER
+
+
+def active_profiler() -> Optional[Profiler]:
+    """Returns the running profiler, `None` when profiling is disabled."""
+
+    return _PROFILER
+
+
+@contextmanager
+def span(name: str, kind: str) -> Iterator[Span]:
+    """Times the `with` block if profiling is enabled, otherwise yields a throwaway span."""
+
+    profiler = _PROFILER
+    if profiler is None:
+        yield Span(name, kind, 0.0)
+        return
+    with profiler.span(name, kind) as current:
+        yield current
+
+
+def profiled(func: Callable[..., T]) -> Callable[..., T]:
+    """Decorator recording a "step" span for every call of `func`."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs) -> T:
+        with span(func.__name__, "step"):
+            return func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,192 @@
+import os
+import re
+import shutil
+import threading
+from http.client import HTTPException
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Optional, Set
+from urllib.parse import urlsplit
+from cache import CACHE_PATH, DownloadCache
+from exceptions import DownloadError, HttpStatusError
+from fetch import CHUNK_SIZE, HttpPool
+from imgs import list_imgs
+from manifest import Manifest
+from sources import KEYSERVER_URL, PPA_URL, keyserver_url, launchpad_url, listed_uris
+
+
+PROXY_PORT = 3142                                       # apt-cacher-ng's, so existing configs keep working
+PROXY_BIND = "127.0.0.1"                                # serving other hosts takes an explicit address
+PROXY_CACHE_PATH = os.path.join(CACHE_PATH, "proxy")
+PROXY_MAX_BYTES = 20 * 1024 ** 3
+IMMUTABLE_SECONDS = 30 * 24 * 3600                      # packages never change once published
+
+# versioned pool packages (`name_<version>_<arch>.deb`, versions start with a digit) and by-hash indexes are
+# named after their content
+IMMUTABLE_PATTERN = re.compile(r"(/pool/(.+/)?[^/_]+_[0-9][^/_]*_[^/_]+\.u?deb|/by-hash/[^/]+/[0-9a-f]+)$")
+# other indexes and packages (e.g. a vendor's `*_current_amd64.deb`) are revalidated on every request
+REVALIDATED_PATTERN = re.compile(r"(/(InRelease|Release(\.gpg)?|(Packages|Sources|Contents-[\w-]+"
+                                 r"|Translation-[\w@.-]+)(\.(gz|xz|bz2|lz4))?)|\.u?deb)$")
+# apt repositories keep their indexes under dists/ and their packages under pool/
+APT_PATH_PATTERN = re.compile(r"/(dists|pool)/")
+PASSED_HEADERS = ("Content-Type", "Content-Length", "Last-Modified", "ETag")
+
+
+def freshness(url: str) -> Optional[float]:
+    """Returns how long a cached copy of `url` is served without revalidation, `None` if it is not cached."""
+
+    path = url.split("?", 1)[0]
+    if IMMUTABLE_PATTERN.search(path):
+        return IMMUTABLE_SECONDS
+    if REVALIDATED_PATTERN.search(path):
+        return 0
+    return None
+
+
+def installer_urls(manifests: Iterable[Manifest]) -> Set[str]:
+    """Returns every url the installer itself downloads for `manifests`, besides apt's."""
+
+    urls = {url for url, _ in list_imgs()}
+    for manifest in manifests:
+        for entry in [*manifest.debs, *manifest.scripts]:
+            urls.update([entry.url, *entry.mirrors])
+        for repo in manifest.repos:
+            if repo.ppa:
+                urls.add(launchpad_url(repo))
+            if repo.fingerprint:
+                urls.add(keyserver_url(repo.fingerprint.replace(" ", "").upper()))
+            if repo.key_url:
+                urls.update([repo.key_url, *repo.key_mirrors])
+    return urls
+
+
+def apt_hosts(manifests: Iterable[Manifest]) -> Set[str]:
+    """Returns the hosts whose apt repositories are proxied: the manifests' and the ones this host uses."""
+
+    uris = listed_uris()
+    for manifest in manifests:
+        for repo in manifest.repos:
+            uris.append(PPA_URL if repo.ppa else repo.uri)
+    return {host for host in (urlsplit(uri).hostname for uri in uris) if host}
+
+
+class ProxyServer(ThreadingHTTPServer):
+    """Caching HTTP proxy for packages, apt indexes and the files the installer downloads.
+
+    apt talks to it as a regular forward proxy (`GET http://host/path`), the installer's own
+    downloads (https ones included) are requested as `GET /https://host/path`. Cached files live
+    in a size-bounded `DownloadCache`, other apt files are passed through untouched. apt files
+    are only fetched from `apt_hosts` and any other url is refused, so the proxy can not be
+    used to reach arbitrary hosts from the LAN.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = PROXY_PORT, root: str = PROXY_CACHE_PATH,
+                 max_bytes: int = PROXY_MAX_BYTES, pool: Optional[HttpPool] = None,
+                 bind: str = PROXY_BIND, allowed_urls: Iterable[str] = (), apt_hosts: Iterable[str] = ()) -> None:
+        super().__init__((bind, port), ProxyHandler)
+        self.cache = DownloadCache(root, max_bytes=max_bytes)
+        self.pool = pool or HttpPool()
+        self.allowed_urls = set(allowed_urls)
+        self.apt_hosts = {host.lower() for host in apt_hosts}
+        self._url_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def allows(self, url: str) -> bool:
+        """Checks if `url` is a file of a known apt repository, a key lookup or an installer download."""
+
+        parts = urlsplit(url)
+        apt_file = bool(APT_PATH_PATTERN.search(parts.path)) and (parts.hostname or "") in self.apt_hosts
+        return apt_file or url in self.allowed_urls or url.startswith(f"{KEYSERVER_URL}/pks/lookup?op=get&")
+
+    def url_lock(self, url: str) -> threading.Lock:
+        """Returns the lock making concurrent requests of a url wait for a single upstream download."""
+
+        with self._lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    """Serves a single proxied request."""
+
+    server: ProxyServer
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        url = self.path[1:] if self.path.startswith("/") else self.path
+        if not url.startswith(("http://", "https://")):
+            self.send_error(400, "Expected an absolute http(s) url")
+            return
+        if not self.server.allows(url):
+            self.send_error(403, "Only apt repositories and the installer's downloads are proxied")
+            return
+
+        fresh_seconds = freshness(url)
+        if fresh_seconds is None:
+            self._pass_through(url)
+            return
+
+        try:
+            with self.server.url_lock(url):
+                path = self.server.cache.fetch(url, self.server.pool, fresh_seconds)
+        except HttpStatusError as exc:
+            # the client sees the upstream answer, e.g. a 404 apt ignores, without asking upstream again
+            self.send_error(exc.status, str(exc))
+        except DownloadError as exc:
+            self.send_error(502, str(exc))
+        else:
+            self._send_file(path)
+
+    def _send_file(self, path: str) -> None:
+        etag = f'"{os.path.basename(path)}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        with open(path, "rb") as file:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.fstat(file.fileno()).st_size))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            shutil.copyfileobj(file, self.wfile, CHUNK_SIZE)
+
+    def _pass_through(self, url: str) -> None:
+        try:
+            with self.server.pool.open(url) as resp:
+                self.send_response(resp.status)
+                for name in PASSED_HEADERS:
+                    value = resp.getheader(name)
+                    if value is not None:
+                        self.send_header(name, value)
+                if resp.getheader("Content-Length") is None:
+                    self.send_header("Connection", "close")
+                    self.close_connection = True
+                self.end_headers()
+                try:
+                    for chunk in iter(lambda: resp.read(CHUNK_SIZE), b""):
+                        self.wfile.write(chunk)
+                except (OSError, HTTPException):
+                    # the headers are gone already, dropping the connection tells the client
+                    self.close_connection = True
+        except DownloadError as exc:
+            self.send_error(502, str(exc))
+
+    def log_message(self, format: str, *args) -> None:
+        print(f"[proxy] {self.address_string()} {format % args}")
+
+
+def start_proxy(port: int = PROXY_PORT, root: str = PROXY_CACHE_PATH,
+                max_bytes: int = PROXY_MAX_BYTES, pool: Optional[HttpPool] = None,
+                bind: str = PROXY_BIND, allowed_urls: Iterable[str] = (),
+                apt_hosts: Iterable[str] = ()) -> ProxyServer:
+    """Starts serving in a background thread, stop it with `shutdown()`."""
+
+    server = ProxyServer(port, root, max_bytes, pool, bind, allowed_urls, apt_hosts)
+    threading.Thread(target=server.serve_forever, name="apollo-proxy", daemon=True).start()
+    address, port = server.server_address[:2]
+    print(f"Caching proxy listening on {address}:{port}.")
+    return server
@@ -0,0 +1,121 @@
+import random
+import signal
+import subprocess as subp
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple, Type, TypeVar
+from cli import Argv, RunResult, Stage, argv_text, interrupted, run
+from exceptions import DownloadError, InstallationError
+
+
+T = TypeVar("T")
+
+
+@dataclass
+class RetryPolicy:
+    """How often and how patiently a network-bound step is retried."""
+
+    attempts: int = 3
+    base_delay: float = 2.0                             # seconds, doubled after every failed attempt
+    max_delay: float = 30.0
+    timeout: Optional[float] = 600.0                    # seconds a single command attempt may run
+
+    def delay(self, attempt: int) -> float:
+        """Returns how long to wait after the failed `attempt` (0 based).
+
+        Full jitter keeps hosts that failed at the same time from retrying in lockstep.
+        """
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+NETWORK_RETRY = RetryPolicy()
+
+RETRIED_ERRORS: Tuple[Type[BaseException], ...] = (InstallationError, DownloadError, subp.TimeoutExpired)
+
+
+def retry_call(func: Callable[[], T], label: str, policy: Optional[RetryPolicy] = None,
+               retry_on: Tuple[Type[BaseException], ...] = RETRIED_ERRORS) -> T:
+    """Calls `func` until it does not raise one of `retry_on`, re-raising the last error.
+
+    Nothing is retried once the run was interrupted (see `cli.interrupt`).
+    """
+
+    policy = policy or NETWORK_RETRY
+    for attempt in range(policy.attempts):
+        try:
+            return func()
+        except retry_on as exc:
+            if attempt + 1 >= policy.attempts or interrupted():
+                raise
+            delay = policy.delay(attempt)
+            print(f"{label} failed ({exc}), retrying in {delay:.1f}s...")
+            # Ctrl-C cuts the back off short
+            if interrupted(delay):
+                raise KeyboardInterrupt
+
+    raise ValueError("A retry policy needs at least one attempt.")
+
+
+def timed_out(argv: Argv, exc: subp.TimeoutExpired) -> RunResult:
+    """Returns the result of an attempt killed on timeout, a stage killed with SIGKILL."""
+
+    return RunResult(b"", [Stage(list(argv), -signal.SIGKILL, f"E: {exc}\n".encode())])
+
+
+def retryable(result: RunResult, retry_if: Optional[Callable[[RunResult], bool]] = None) -> bool:
+    """Checks if `result` failed in a way worth another attempt, any failure without `retry_if`."""
+
+    return not result.ok and (retry_if is None or retry_if(result))
+
+
+def failure_reason(result: RunResult) -> str:
+    """Returns the last stderr line of the failed stage of `result`, or its exit code."""
+
+    failed = result.failed_stage
+    lines = failed.stderr.decode(errors="replace").strip().splitlines() if failed else []
+    return lines[-1] if lines else f"exit code {result.returncode}"
+
+
+def retry_cmd(argv: Argv, policy: Optional[RetryPolicy] = None,
+              retry_if: Optional[Callable[[RunResult], bool]] = None) -> RunResult:
+    """Runs `argv` until it exits successfully, with the policy's timeout on every attempt.
+
+    Returns the result of the last attempt. An attempt that timed out is reported as a
+    stage killed with SIGKILL, so callers check the outcome exactly as they would after `run`.
+    A failure `retry_if` rejects is returned right away, it would fail the same way again.
+    """
+
+    policy = policy or NETWORK_RETRY
+    last: List[RunResult] = []
+
+    def attempt() -> RunResult:
+        try:
+            last[:] = [run(argv, timeout=policy.timeout)]
+        except subp.TimeoutExpired as exc:
+            last[:] = [timed_out(argv, exc)]
+        if retryable(last[0], retry_if):
+            raise InstallationError(failure_reason(last[0]))
+        return last[0]
+
+    try:
+        return retry_call(attempt, argv_text(argv), policy)
+    except InstallationError:
+        return last[0]
+
+
+def fetch_mirrors(urls: List[str], fetch: Callable[[str], T], policy: Optional[RetryPolicy] = None) -> T:
+    """Fetches the first of `urls` that works, with `fetch`.
+
+    Every mirror is tried in turn before backing off, so a dead mirror only costs one request.
+    """
+
+    def attempt() -> T:
+        errors: List[str] = []
+        for url in urls:
+            try:
+                return fetch(url)
+            except DownloadError as exc:
+                errors.append(str(exc))
+        raise DownloadError(" ".join(errors))
+
+    return retry_call(attempt, f"Downloading {urls[0]}", policy, retry_on=(DownloadError,))
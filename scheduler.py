@@ -0,0 +1,149 @@
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+from cli import interrupt, interrupted
+from exceptions import SchedulerError
+from journal import Journal, inputs_hash
+from profiling import span
+
+
+DPKG_LOCK = "dpkg"                                      # held by anything that runs apt/dpkg
+
+
+@dataclass
+class Task:
+    """A node of the installation graph.
+
+    `deps` are the names of the tasks that must succeed before this one starts and
+    `locks` are the names of the resources it can not share with other running tasks.
+    `probe` is a cheap check telling if the work is already done, in which case `func`
+    is skipped. `inputs` is whatever the task works on, a journaled task is only skipped
+    on a later run while its inputs stay the same.
+    """
+
+    name: str
+    func: Callable[[], object]
+    deps: List[str] = field(default_factory=list)
+    locks: List[str] = field(default_factory=list)
+    probe: Optional[Callable[[], bool]] = None
+    inputs: object = None
+
+
+def check_graph(tasks: List[Task]) -> None:
+    """Makes sure every dependency exists and that the graph has no cycles."""
+
+    names = {task.name for task in tasks}
+    if len(names) != len(tasks):
+        raise SchedulerError("Task names must be unique.")
+
+    for task in tasks:
+        for dep in task.deps:
+            if dep not in names:
+                raise SchedulerError(f"Task {task.name} depends on unknown task {dep}.")
+
+    deps = {task.name: set(task.deps) for task in tasks}
+    while deps:
+        ready = [name for name, pending in deps.items() if not pending]
+        if not ready:
+            raise SchedulerError(f"Circular dependency between {', '.join(sorted(deps))}.")
+        for name in ready:
+            del deps[name]
+        for pending in deps.values():
+            pending.difference_update(ready)
+
+
+def run_graph(tasks: List[Task], max_workers: int = 4,
+              journal: Optional[Journal] = None) -> Dict[str, BaseException]:
+    """Runs `tasks` as soon as their dependencies succeed, at most `max_workers` at a time.
+
+    Returns the exception raised by every failed task. Tasks depending on a failed task
+    are not run and are reported with a `SchedulerError`. With a `journal`, tasks completed
+    by a previous run are skipped and every task that succeeds is recorded.
+
+    On Ctrl-C the running commands are killed (see `cli.interrupt`), no other task starts and
+    `KeyboardInterrupt` is raised once the running tasks stopped. Interrupted tasks are not journaled.
+    """
+
+    check_graph(tasks)
+
+    by_name = {task.name: task for task in tasks}
+    dependents: Dict[str, List[str]] = {task.name: [] for task in tasks}
+    pending = {task.name: len(task.deps) for task in tasks}
+    for task in tasks:
+        for dep in task.deps:
+            dependents[dep].append(task.name)
+
+    locks = {name: threading.Lock() for task in tasks for name in task.locks}
+    failures: Dict[str, BaseException] = {}
+
+    def run_task(task: Task) -> None:
+        if interrupted():
+            raise KeyboardInterrupt
+        digest = inputs_hash([task.name, task.inputs])
+        if journal is not None and journal.is_done(task.name, digest):
+            print(f"{task.name} was completed by a previous run, skipping.")
+            return None
+
+        with span(task.name, "step"):
+            if task.probe is not None and task.probe():
+                print(f"{task.name} is already satisfied, skipping.")
+            else:
+                run_locked(task)
+
+        if interrupted():
+            raise KeyboardInterrupt
+        if journal is not None:
+            journal.record(task.name, digest)
+        return None
+
+    def run_locked(task: Task) -> object:
+        # acquire in a fixed order so two tasks sharing several locks can not deadlock
+        held = [locks[name] for name in sorted(set(task.locks))]
+        for lock in held:
+            lock.acquire()
+        try:
+            return task.func()
+        finally:
+            for lock in reversed(held):
+                lock.release()
+
+    def skip_dependents(name: str) -> None:
+        for dependent in dependents[name]:
+            if dependent not in failures:
+                failures[dependent] = SchedulerError(f"Skipped because {name} failed.")
+                skip_dependents(dependent)
+
+    ready = [task.name for task in tasks if not task.deps]
+    running: Dict[Future, str] = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        try:
+            while ready or running:
+                for name in ready:
+                    running[pool.submit(run_task, by_name[name])] = name
+                ready = []
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    exc = future.exception()
+                    if isinstance(exc, KeyboardInterrupt):
+                        raise exc
+                    if exc is not None:
+                        failures[name] = exc
+                        skip_dependents(name)
+                        continue
+
+                    for dependent in dependents[name]:
+                        pending[dependent] -= 1
+                        if not pending[dependent] and dependent not in failures:
+                            ready.append(dependent)
+        except KeyboardInterrupt:
+            # the pool waits for the running tasks on exit, they stop as soon as their command is killed
+            interrupt()
+            for future in running:
+                future.cancel()
+            raise
+
+    return failures
@@ -0,0 +1,183 @@
+import glob
+import json
+import os
+import platform
+import re
+import shlex
+from functools import lru_cache
+from typing import Dict, List
+from cache import default_cache
+from exceptions import DownloadError, InstallationError
+from fsutil import write_if_changed
+from manifest import Repo
+from retry import fetch_mirrors
+
+
+KEYRINGS_PATH = "/usr/share/keyrings"
+SOURCES_PATH = "/etc/apt/sources.list.d"
+SOURCES_LIST_PATH = "/etc/apt/sources.list"
+OS_RELEASE_PATH = "/etc/os-release"
+LAUNCHPAD_API_URL = "https://api.launchpad.net/devel"
+KEYSERVER_URL = "https://keyserver.ubuntu.com"
+PPA_URL = "https://ppa.launchpadcontent.net"
+
+# `platform.machine()` names of the architectures dpkg calls differently
+DPKG_ARCHITECTURES = {
+    "x86_64": "amd64",
+    "aarch64": "arm64",
+    "armv7l": "armhf",
+    "i686": "i386",
+    "ppc64le": "ppc64el",
+}
+
+
+def os_release(path: str = "") -> Dict[str, str]:
+    """Parses an os-release file <https://www.freedesktop.org/software/systemd/man/os-release.html>."""
+
+    release: Dict[str, str] = {}
+    with open(path or OS_RELEASE_PATH) as file:
+        for line in file:
+            key, sep, value = line.strip().partition("=")
+            if not sep or key.startswith("#"):
+                continue
+            try:
+                # values follow shell quoting rules
+                release[key] = "".join(shlex.split(value))
+            except ValueError:
+                release[key] = value.strip("\"'")
+    return release
+
+
+@lru_cache(maxsize=None)
+def host_release() -> Dict[str, str]:
+    """Returns the values of the `{arch}` and `{codename}` placeholders for this host.
+
+    Read from `/etc/os-release` and the machine name, instead of running `dpkg` and `lsb_release`.
+    The Ubuntu codename wins on derivatives (e.g. Mint), third-party repositories only know Ubuntu's.
+    """
+
+    try:
+        release = os_release()
+    except OSError as exc:
+        raise InstallationError(f"Could not read the host's release: {exc}")
+
+    machine = platform.machine()
+    codename = release.get("UBUNTU_CODENAME") or release.get("VERSION_CODENAME", "")
+    return {"arch": DPKG_ARCHITECTURES.get(machine, machine), "codename": codename}
+
+
+def keyring_path(repo: Repo) -> str:
+    """Returns where the signing keys of `repo` are stored."""
+
+    return os.path.join(KEYRINGS_PATH, repo.keyring or f"{repo.name}-archive-keyring.gpg")
+
+
+def sources_path(repo: Repo) -> str:
+    """Returns the path of the deb822 source file of `repo`."""
+
+    return os.path.join(SOURCES_PATH, f"{repo.name}.sources")
+
+
+def launchpad_url(repo: Repo) -> str:
+    """Returns the Launchpad API url describing the ppa of `repo`."""
+
+    owner, name = repo.ppa.split("/")
+    return f"{LAUNCHPAD_API_URL}/~{owner}/+archive/ubuntu/{name}"
+
+
+def keyserver_url(fingerprint: str) -> str:
+    """Returns the url of the ASCII armored key with `fingerprint` on Ubuntu's key server."""
+
+    return f"{KEYSERVER_URL}/pks/lookup?op=get&options=mr&search=0x{fingerprint}"
+
+
+def signing_fingerprint(repo: Repo) -> str:
+    """Returns the fingerprint the key of `repo` must have, empty if any key goes.
+
+    A ppa without a pinned fingerprint asks Launchpad, with a single cached request.
+    """
+
+    if repo.fingerprint or not repo.ppa:
+        return repo.fingerprint.replace(" ", "").upper()
+
+    try:
+        with open(fetch_mirrors([launchpad_url(repo)], default_cache().fetch)) as file:
+            return json.load(file)["signing_key_fingerprint"].upper()
+    except (DownloadError, OSError, ValueError, KeyError, AttributeError) as exc:
+        raise InstallationError(f"Could not look up the signing key of ppa:{repo.ppa}: {exc}")
+
+
+def key_urls(repo: Repo, fingerprint: str) -> List[str]:
+    """Returns the urls the key of `repo` is fetched from, in order."""
+
+    if repo.ppa:
+        return [keyserver_url(fingerprint)]
+    return [repo.key_url, *repo.key_mirrors]
+
+
+def source_entry(repo: Repo) -> str:
+    """Returns the deb822 source entry of a repository signed by its own keyring."""
+
+    host = host_release()
+    if repo.ppa:
+        owner, name = repo.ppa.split("/")
+        uri, suite, components = f"{PPA_URL}/{owner}/{name}/ubuntu", repo.suite or "{codename}", ["main"]
+    else:
+        uri, suite, components = repo.uri, repo.suite, repo.components
+
+    fields = {
+        "Types": "deb",
+        "URIs": uri,
+        "Suites": suite.format(**host),
+        "Components": " ".join(components),
+        "Architectures": repo.arch.format(**host),
+        "Signed-By": keyring_path(repo),
+    }
+    return "".join(f"{key}: {value}\n" for key, value in fields.items())
+
+
+def ppa_listed(repo: Repo) -> bool:
+    """Checks if `add-apt-repository` registered the ppa of `repo` already."""
+
+    owner, name = repo.ppa.split("/")
+    return any(entry.startswith(f"{owner}-ubuntu-{name}-") for entry in os.listdir(SOURCES_PATH))
+
+
+def write_sources(repo: Repo) -> bool:
+    """Writes the source file of `repo`, returns whether it changed.
+
+    The one-line `.list` file older versions wrote is removed, apt complains about sources
+    configured twice.
+    """
+
+    legacy = os.path.join(SOURCES_PATH, f"{repo.name}.list")
+    if os.path.isfile(legacy):
+        os.unlink(legacy)
+
+    return write_if_changed(sources_path(repo), source_entry(repo).encode())
+
+
+def listed_uris() -> List[str]:
+    """Returns the repository uris of this host's apt sources, one-line `.list` and deb822 `.sources` alike."""
+
+    paths = [SOURCES_LIST_PATH, *sorted(glob.glob(os.path.join(SOURCES_PATH, "*.list"))
+                                        + glob.glob(os.path.join(SOURCES_PATH, "*.sources")))]
+    uris: List[str] = []
+    for path in paths:
+        try:
+            with open(path) as file:
+                lines = [line.split("#", 1)[0].strip() for line in file]
+        except OSError:
+            continue
+
+        for line in lines:
+            if path.endswith(".sources"):
+                key, sep, value = line.partition(":")
+                if sep and key.strip().lower() == "uris":
+                    uris.extend(value.split())
+            elif line.startswith(("deb ", "deb-src ")):
+                # `deb [arch=amd64 signed-by=...] uri suite components...`
+                words = re.sub(r"\[[^]]*\]", " ", line).split()
+                if len(words) > 1:
+                    uris.append(words[1])
+    return uris
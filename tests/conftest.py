@@ -0,0 +1,99 @@
+import hashlib
+import os
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+import pytest
+
+
+# the installer's modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Upstream(ThreadingHTTPServer):
+    """Local stand-in for a mirror serving `files`, with ETags and byte ranges like a real one.
+
+    Every request is logged in `requests` as `(path, headers)`. A path in `drop_after` has its
+    connection cut after that many bytes of the body, ranges are ignored for the paths in
+    `no_ranges`, which get the whole file with a 200 instead, and a path in `shifted_ranges`
+    answers a range starting that many bytes further than asked.
+    """
+
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), UpstreamHandler)
+        self.files: Dict[str, bytes] = {}
+        self.requests: List[Tuple[str, Dict[str, str]]] = []
+        self.drop_after: Dict[str, int] = {}
+        self.no_ranges: List[str] = []
+        self.shifted_ranges: Dict[str, int] = {}
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+    def hits(self, path: str) -> int:
+        return sum(1 for requested, _ in self.requests if requested == path)
+
+    def handle_error(self, request, client_address) -> None:
+        # clients dropping a response half way through is what some tests are about
+        pass
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    server: Upstream
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        self.server.requests.append((self.path, dict(self.headers)))
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start = 0
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match and self.path not in self.server.no_ranges and self.headers.get("If-Range") in (None, etag):
+            start = int(match.group(1)) + self.server.shifted_ranges.get(self.path, 0)
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+
+        drop: Optional[int] = self.server.drop_after.get(self.path)
+        if drop is not None:
+            self.wfile.write(body[start:start + drop])
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def upstream():
+    server = Upstream()
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
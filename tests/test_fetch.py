@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import pytest
+from exceptions import DownloadError, HttpStatusError
+from fetch import HttpPool, download
+
+
+BODY = bytes(range(256)) * 1024
+SHA256 = hashlib.sha256(BODY).hexdigest()
+
+
+def part_files(dest: str):
+    return [path for path in (f"{dest}.part", f"{dest}.part.json") if os.path.exists(path)]
+
+
+def leave_part(upstream, dest: str, size: int) -> None:
+    """Simulates an attempt interrupted after `size` bytes."""
+
+    upstream.drop_after["/file"] = size
+    with pytest.raises(DownloadError):
+        download(upstream.url("/file"), dest, HttpPool())
+    del upstream.drop_after["/file"]
+    assert os.path.getsize(f"{dest}.part") == size
+
+
+def test_download(upstream, tmp_path):
+    upstream.files["/file"] = BODY
+    dest = str(tmp_path / "file")
+
+    result = download(upstream.url("/file"), dest, HttpPool(), SHA256)
+
+    assert (result.path, result.sha256, result.size) == (dest, SHA256, len(BODY))
+    assert open(dest, "rb").read() == BODY
+    assert not part_files(dest)
+
+
+def test_resume(upstream, tmp_path):
+    upstream.files["/file"] = BODY
+    dest = str(tmp_path / "file")
+    leave_part(upstream, dest, 100_000)
+    validator = json.load(open(f"{dest}.part.json"))["validator"]
+
+    result = download(upstream.url("/file"), dest, HttpPool(), SHA256)
+
+    headers = upstream.requests[-1][1]
+    assert headers["Range"] == "bytes=100000-"
+    assert headers["If-Range"] == validator
+    assert result.sha256 == SHA256
+    assert open(dest, "rb").read() == BODY
+    assert not part_files(dest)
+
+
+def test_resume_after_upstream_changed(upstream, tmp_path):
+    upstream.files["/file"] = b"old" * 50_000
+    dest = str(tmp_path / "file")
+    leave_part(upstream, dest, 100_000)
+    upstream.files["/file"] = BODY
+
+    # If-Range no longer matches, the server sends the whole new file
+    assert download(upstream.url("/file"), dest, HttpPool(), SHA256).size == len(BODY)
+    assert open(dest, "rb").read() == BODY
+
+
+@pytest.mark.parametrize("setup", ["unsatisfiable", "shifted"])
+def test_stale_part_restarts(upstream, tmp_path, setup):
+    upstream.files["/file"] = BODY
+    dest = str(tmp_path / "file")
+    leave_part(upstream, dest, 100_000)
+    if setup == "unsatisfiable":
+        # a part longer than the file gets a 416
+        with open(f"{dest}.part", "ab") as file:
+            file.write(b"x" * len(BODY))
+    else:
+        upstream.shifted_ranges["/file"] = 10
+
+    result = download(upstream.url("/file"), dest, HttpPool(), SHA256)
+
+    assert result.size == len(BODY)
+    assert open(dest, "rb").read() == BODY
+    assert not part_files(dest)
+    assert "Range" not in upstream.requests[-1][1]
+
+
+def test_checksum_mismatch_discards_part(upstream, tmp_path):
+    upstream.files["/file"] = BODY
+    dest = str(tmp_path / "file")
+
+    with pytest.raises(DownloadError, match="Checksum mismatch"):
+        download(upstream.url("/file"), dest, HttpPool(), "0" * 64)
+
+    assert not os.path.exists(dest)
+    assert not part_files(dest)
+
+
+def test_missing_file(upstream, tmp_path):
+    with pytest.raises(HttpStatusError) as error:
+        download(upstream.url("/missing"), str(tmp_path / "file"), HttpPool())
+    assert error.value.status == 404
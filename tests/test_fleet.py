@@ -0,0 +1,74 @@
+import os
+import pytest
+from exceptions import FleetError
+from fleet import Host, LocalTransport, fleet_summary, load_inventory, run_fleet
+
+
+# `b` fails its second phase, every host runs from its own copy of the installer
+PHASES = [
+    ("check", "test -f main.py && echo installer here"),
+    ("install", 'host=$(basename "$PWD"); [ "$host" != b ] || { echo "$host is broken" >&2; exit 3; }'),
+]
+
+
+@pytest.fixture
+def installer(tmp_path):
+    src = tmp_path / "src"
+    (src / "fleet_logs").mkdir(parents=True)
+    (src / "main.py").write_text("")
+    (src / "fleet_logs" / "old.log").write_text("")
+    return str(src)
+
+
+def test_run_fleet(installer, tmp_path):
+    hosts = [Host("a", "10.0.0.1"), Host("b", "10.0.0.2"), Host("c", "10.0.0.3")]
+    transport = LocalTransport(str(tmp_path / "hosts"))
+
+    results = run_fleet(hosts, transport, installer, max_workers=2, logs_path=str(tmp_path / "logs"),
+                        phases=PHASES)
+
+    assert [(result.host, result.ok, result.failed_phase, result.exit_code) for result in results] == [
+        ("a", True, "", None), ("b", False, "install", 3), ("c", True, "", None)]
+    assert not os.path.exists(os.path.join(transport.host_dir(hosts[0]), "fleet_logs"))
+
+    log_a = open(results[0].log_path).read()
+    assert "==> push" in log_a and "installer here" in log_a
+    assert "b is broken" in open(results[1].log_path).read()
+    assert "b is broken" not in log_a
+
+    summary = fleet_summary(results)
+    assert "failed at install (3)" in summary
+    assert summary.endswith("2 succeeded, 1 failed.")
+
+
+def test_run_fleet_timeout(installer, tmp_path):
+    results = run_fleet([Host("a", "10.0.0.1")], LocalTransport(str(tmp_path / "hosts")), installer,
+                        logs_path=str(tmp_path / "logs"), phases=[("install", "sleep 5")], timeout=0.2)
+
+    assert (results[0].ok, results[0].failed_phase, results[0].exit_code) == (False, "install", None)
+    assert "timed out" in open(results[0].log_path).read()
+
+
+HOST_A = '[[host]]\nname = "a"\naddress = "10.0.0.1"\n'
+
+
+@pytest.mark.parametrize("inventory, error", [
+    (HOST_A + HOST_A.replace("10.0.0.1", "10.0.0.2"), "Duplicate hosts"),
+    ("", "No hosts"),
+    ('[[host]]\nname = "a"\n', "Invalid host entry"),
+])
+def test_load_inventory_rejects(tmp_path, inventory, error):
+    path = tmp_path / "hosts.toml"
+    path.write_text(inventory)
+
+    with pytest.raises(FleetError, match=error):
+        load_inventory(str(path))
+
+
+def test_load_inventory(tmp_path):
+    path = tmp_path / "hosts.toml"
+    path.write_text(HOST_A + 'user = "ops"\nport = 2222\n')
+
+    assert load_inventory(str(path)) == [Host("a", "10.0.0.1", "ops", 2222)]
+    with pytest.raises(FleetError, match="Could not read"):
+        load_inventory(str(tmp_path / "missing.toml"))
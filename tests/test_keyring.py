@@ -0,0 +1,45 @@
+from pathlib import Path
+import pytest
+from exceptions import KeyringError
+from keyring import dearmor, fingerprints, packets
+
+
+FIXTURES = Path(__file__).parent / "fixtures"
+# `gpg --list-keys --with-colons` of the fixture, an ed25519 primary key with a cv25519 subkey
+FIXTURE_FINGERPRINT = "8987026FBAF5579B6D3D3F9D4C1251BB12494EA3"
+
+
+def test_packets_of_exported_key():
+    keyring = dearmor((FIXTURES / "test-key.asc").read_bytes())
+
+    # public key, user id, self signature, public subkey, binding signature
+    assert [tag for tag, _ in packets(keyring)] == [6, 13, 2, 14, 2]
+    assert fingerprints(keyring) == [FIXTURE_FINGERPRINT]
+
+
+@pytest.mark.parametrize("keyring, expected", [
+    # old format, one, two and four byte lengths
+    (b"\x98\x03abc", [(6, b"abc")]),
+    (b"\xb5\x00\x02hi", [(13, b"hi")]),
+    (b"\x8a\x00\x00\x00\x01x", [(2, b"x")]),
+    # new format, one, two and five byte lengths
+    (b"\xc6\x03abc", [(6, b"abc")]),
+    (b"\xcd\xc0\x00" + b"u" * 192, [(13, b"u" * 192)]),
+    (b"\xc2\xff\x00\x00\x00\x02ok", [(2, b"ok")]),
+    (b"\xc6\x01a\xce\x01b", [(6, b"a"), (14, b"b")]),
+    (b"", []),
+])
+def test_packets_lengths(keyring, expected):
+    assert list(packets(keyring)) == expected
+
+
+@pytest.mark.parametrize("keyring", [
+    b"\x06\x03abc",                                     # no packet tag bit
+    b"\x98\x05abc",                                     # body shorter than its length
+    b"\xc6",                                            # missing length
+    b"\xc6\xe1abc",                                     # partial body length
+    b"\x9b",                                            # indeterminate length
+])
+def test_packets_rejects(keyring):
+    with pytest.raises(KeyringError):
+        list(packets(keyring))
@@ -0,0 +1,50 @@
+from pathlib import Path
+import pytest
+from exceptions import ManifestError
+from manifest import _parse_toml_subset
+
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def test_parse_toml_subset():
+    doc = _parse_toml_subset((FIXTURES / "subset.toml").read_text())
+
+    assert doc == {
+        "apt": ["git", "tmux", "vim"],
+        "options": {
+            "name": 'a "quoted" # not a comment',
+            "odd": 'x " # y',
+            "backslash": "ends with \\",
+            "brackets": ['" ]', "]"],
+            "path": "C:\\raw\\string",
+            "enabled": True,
+            "disabled": False,
+            "retries": 3,
+            "offset": -2,
+            "nested": [[1, 2], ["three"]],
+        },
+        "repo": [
+            {"name": "docker", "components": ["stable"]},
+            {"name": "fish", "ppa": "fish-shell/release-3"},
+        ],
+    }
+
+
+def test_parse_toml_subset_matches_tomllib():
+    tomllib = pytest.importorskip("tomllib")
+    text = (FIXTURES / "subset.toml").read_text()
+
+    assert _parse_toml_subset(text) == tomllib.loads(text)
+
+
+@pytest.mark.parametrize("text", [
+    "[[repo]\n",
+    "apt\n",
+    'name = "docker" "fish"\n',
+    "when = 1979-05-27\n",
+    'apt = ["git" "tmux"]\n',
+])
+def test_parse_toml_subset_rejects(text):
+    with pytest.raises(ManifestError):
+        _parse_toml_subset(text)
@@ -0,0 +1,15 @@
+from pathlib import Path
+from pkg_index import parse_dpkg_status
+
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def test_parse_dpkg_status_keeps_installed_packages():
+    pkgs = parse_dpkg_status((FIXTURES / "dpkg-status").read_text())
+
+    assert pkgs == {"bash": "5.1-6ubuntu1", "tmux": "3.2a-4ubuntu0.2", "curl": "7.81.0-1ubuntu1.15"}
+
+
+def test_parse_dpkg_status_empty():
+    assert parse_dpkg_status("") == {}
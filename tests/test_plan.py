@@ -0,0 +1,31 @@
+import json
+import pytest
+from plan import ROOT, USER, Op, Plan
+
+
+PLAN = Plan([
+    Op("mkdir", ROOT, "mkdir -p /opt/apollo", {"path": "/opt/apollo"}),
+    Op("download", USER, "download https://example.com/a.png to /home/me/a.png",
+       {"url": "https://example.com/a.png", "dest": "/home/me/a.png"}, 1024),
+])
+
+
+def test_round_trip():
+    assert Plan.from_json(PLAN.to_json()) == PLAN
+
+
+@pytest.mark.parametrize("change, error", [
+    ({"kind": "rm_rf"}, "Unknown op kind"),
+    ({"phase": "admin"}, "Unknown phase"),
+])
+def test_from_json_rejects(change, error):
+    data = json.loads(PLAN.to_json())
+    data["ops"][1].update(change)
+
+    with pytest.raises(ValueError, match=error):
+        Plan.from_json(json.dumps(data))
+
+
+def test_from_json_rejects_other_versions():
+    with pytest.raises(ValueError, match="Unsupported plan version"):
+        Plan.from_json(json.dumps({"version": 0, "ops": []}))
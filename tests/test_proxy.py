@@ -0,0 +1,89 @@
+import pytest
+from fetch import HttpPool
+from proxy import IMMUTABLE_SECONDS, ProxyServer, freshness, start_proxy
+
+
+DEB = "/ubuntu/pool/main/t/tmux/tmux_3.2a-4_amd64.deb"
+INDEX = "/ubuntu/dists/jammy/InRelease"
+
+
+@pytest.fixture
+def proxy(upstream, tmp_path):
+    server = start_proxy(0, str(tmp_path), apt_hosts=["127.0.0.1"], allowed_urls=[upstream.url("/wallpaper.png")])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get(proxy: ProxyServer, url: str):
+    pool = HttpPool(proxy=f"http://127.0.0.1:{proxy.server_address[1]}")
+    with pool.open(url) as resp:
+        return resp.status, resp.read()
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("http://archive.ubuntu.com/ubuntu/pool/main/t/tmux/tmux_3.2a-4_amd64.deb", IMMUTABLE_SECONDS),
+    ("http://archive.ubuntu.com/ubuntu/dists/jammy/main/binary-amd64/by-hash/SHA256/0a1b2c", IMMUTABLE_SECONDS),
+    ("http://archive.ubuntu.com/ubuntu/dists/jammy/InRelease", 0),
+    ("http://archive.ubuntu.com/ubuntu/dists/jammy/main/binary-amd64/Packages.xz", 0),
+    ("https://example.com/pool/vendor_current_amd64.deb", 0),
+    ("https://example.com/download/latest.deb", 0),
+    ("https://example.com/wallpaper.png", None),
+])
+def test_freshness(url, expected):
+    assert freshness(url) == expected
+
+
+def test_allows(tmp_path):
+    server = ProxyServer(0, str(tmp_path), apt_hosts=["archive.ubuntu.com"],
+                         allowed_urls=["https://example.com/wallpaper.png"])
+    try:
+        assert server.allows("http://archive.ubuntu.com/ubuntu/dists/jammy/InRelease")
+        assert server.allows("https://example.com/wallpaper.png")
+        assert server.allows("https://keyserver.ubuntu.com/pks/lookup?op=get&options=mr&search=0xABCD")
+        assert not server.allows("http://10.0.0.1/dists/jammy/InRelease")
+        assert not server.allows("http://archive.ubuntu.com/admin")
+        assert not server.allows("https://example.com/other.png")
+    finally:
+        server.server_close()
+
+
+def test_refuses_other_urls(proxy, upstream):
+    upstream.files["/secret"] = b"internal"
+
+    assert get(proxy, upstream.url("/secret"))[0] == 403
+    assert not upstream.requests
+
+
+def test_package_cached(proxy, upstream):
+    upstream.files[DEB] = b"deb" * 1000
+
+    assert get(proxy, upstream.url(DEB)) == (200, b"deb" * 1000)
+    assert get(proxy, upstream.url(DEB)) == (200, b"deb" * 1000)
+    assert upstream.hits(DEB) == 1
+
+
+def test_index_revalidated(proxy, upstream):
+    upstream.files[INDEX] = b"release 1"
+    assert get(proxy, upstream.url(INDEX)) == (200, b"release 1")
+
+    assert get(proxy, upstream.url(INDEX)) == (200, b"release 1")
+    assert upstream.hits(INDEX) == 2
+    assert "If-None-Match" in upstream.requests[-1][1]
+
+    upstream.files[INDEX] = b"release 2"
+    assert get(proxy, upstream.url(INDEX)) == (200, b"release 2")
+
+
+def test_missing_file_asked_once(proxy, upstream):
+    assert get(proxy, upstream.url(DEB))[0] == 404
+    assert upstream.hits(DEB) == 1
+
+
+def test_pass_through(proxy, upstream):
+    upstream.files["/wallpaper.png"] = b"png"
+
+    assert get(proxy, upstream.url("/wallpaper.png")) == (200, b"png")
+    assert get(proxy, upstream.url("/wallpaper.png")) == (200, b"png")
+    # not cached, every request reaches upstream
+    assert upstream.hits("/wallpaper.png") == 2